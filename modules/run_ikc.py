@@ -1,347 +1,495 @@
-import csv
+import os
+import sys
 import time
+import contextlib
+import collections
 import logging
 import argparse
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 import networkit as nk
+import scipy.sparse as sp
+from scipy.sparse import csgraph
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from toolkit import graph_cache
+from toolkit.sniff import get_delimiter
+
+# Buffer of the output file, which is written one level of clusters at a time
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Nodes below which lowered core numbers are propagated one node at a time (see lower_core_numbers)
+PEEL_BATCH_SIZE = 64
 
 
 def main(args):
+    # a single k keeps the output path as it is
+    if len(args.kvalue) == 1 and len(args.output) == 1:
+        k, output = args.kvalue[0], args.output[0]
+    else:
+        k, output = args.kvalue, args.output[0] if len(args.output) == 1 else args.output
+    run_ikc(
+        args.edgelist,
+        output,
+        k,
+        args.quiet,
+        cache_dir=args.graph_cache,
+        modularity_check=args.modularity_check,
+        extra_columns=args.extra_columns,
+    )
+
+
+def run_ikc(
+    edgelist,
+    output,
+    k=0,
+    quiet_output=False,
+    graph=None,
+    cache_dir=None,
+    modularity_check=False,
+    extra_columns=False,
+):
+    """Run IKC on `edgelist` and write the clustering to `output`.
+
+    `k` may also be a list of values, with `output` a list of as many paths (a
+    single path gets the k appended, see multi_k_outputs): the core hierarchy is
+    then computed once and the clustering of every k is derived from it.
+
+    With `modularity_check`, only clusters with a positive modularity are kept
+    (the m-valid clusters of the IKC paper). With `extra_columns`, the output also
+    has the k and modularity of every cluster.
+
+    `graph` and `cache_dir`: see graph_cache.load_graph.
+    """
     global quiet
 
-    edgelist = args.edgelist
-    output_file = Path(args.output)
-    k = args.kvalue
-    quiet = args.quiet
+    quiet = quiet_output
+    if isinstance(k, (list, tuple)):
+        ks = [int(value) for value in k]
+        outputs = output if isinstance(output, (list, tuple)) else multi_k_outputs(output, ks)
+        if len(outputs) != len(ks):
+            raise ValueError(f"{len(ks)} values of k need as many outputs, not {len(outputs)}")
+        if len(set(ks)) != len(ks):
+            raise ValueError(f"Repeated value of k in {ks}")
+    else:
+        ks, outputs = [int(k)], [output]
 
     # ===========
 
     start = time.perf_counter()
 
     delimiter = get_delimiter(edgelist)
-    edge_list_reader = nk.graphio.EdgeListReader(
-        delimiter, 0, continuous=False, directed=True
-    )
-    graph1 = edge_list_reader.read(edgelist)
-    node_id_map = edge_list_reader.getNodeMap()
-    inverted_node_id_map = dict(map(reversed, node_id_map.items()))
-
-    graph, node_id_dict = format_graph(graph1)
+    if graph is None:
+        graph = graph_cache.load_graph(edgelist, cache_dir)
+    offsets, neighbors = build_adjacency(graph.sources(), graph.targets, graph.n_nodes)
 
     elapsed = time.perf_counter() - start
     logging.info(f"[TIME] Loading network: {elapsed}")
 
     # ===========
 
+    # clusters are written out as soon as they are found, the time spent writing is timed apart
     start = time.perf_counter()
 
-    clusters = iterative_k_core_decomposition_MCS_ES(graph, k, node_id_dict)
+    with contextlib.ExitStack() as stack:
+        writers = {
+            k_value: ClusterWriter(Path(path), graph.node_ids, delimiter, extra_columns)
+            for k_value, path in zip(ks, outputs)
+        }
+        for writer in writers.values():
+            stack.enter_context(writer)
+        iterative_k_core_decomposition_MCS_ES(
+            offsets, neighbors, writers, modularity_check
+        )
 
-    elapsed = time.perf_counter() - start
+    saving = sum(writer.elapsed for writer in writers.values())
+    elapsed = time.perf_counter() - start - saving
     logging.info(f"[TIME] Running IKC algorithm: {elapsed}")
+    logging.info(f"[TIME] Saving results: {saving}")
 
-    # ===========
 
-    start = time.perf_counter()
+def multi_k_outputs(output, ks):
+    """Output paths for several values of k: out.csv becomes out-k5.csv, out-k10.csv, ..."""
+    stem, extension = os.path.splitext(output)
+    return [f"{stem}-k{k}{extension}" for k in ks]
 
-    print_clusters(clusters, output_file, inverted_node_id_map, delimiter)
 
-    elapsed = time.perf_counter() - start
-    logging.info(f"[TIME] Saving results: {elapsed}")
-
-
-# delimiter checking
-def get_delimiter(filepath: str) -> str:
-    with open(filepath, "r") as f:
-        for current_line in f:
-            if "," in current_line:
-                return ","
-            elif " " in current_line:
-                return " "
-            elif "\t" in current_line:
-                return "\t"
-            else:
-                raise ValueError(
-                    "Unsupported delimiter: delimiter must be either comma, tab, or whitespace."
-                )
-
-
-def print_clusters(clusters, output_file, inverted_node_id_map, delimiter="\t"):
+class ClusterWriter:
     """
-    This writes a csv containing lines with the:
-    node Id, cluster nbr, and value of k for which cluster nbr was generated
-    INPUT
-    -----
-    clusters : a list of clusters represented as lists of nodes in each cluster
-    outDir : the file path and name of the ouput
+    Writes the clusters IKC finds as soon as they are found, one level at a time, with one line
+    per node: node_id, cluster_id and, with extra_columns, the k and modularity of the cluster
+    Clusters are numbered from 1 in the order they are written, and clusters of a single node are
+    skipped
     """
-    # the index indicates the order for when the cluster number was generated
-    index = 0
-    k = 0
-    with open(output_file, "w") as output:
-        csvwriter = csv.writer(output, delimiter=delimiter, lineterminator="\n")
-        csvwriter.writerow(["node_id", "cluster_id"])
-        for cluster_info in clusters:
-            (cluster, k, modularity_score) = cluster_info
-
-            if len(cluster) <= 1:
-                continue
 
-            index += 1
-            # print a separate line for each node in each cluster
-            for node in cluster:
-                csvwriter.writerow([inverted_node_id_map[node], index])
+    def __init__(self, output_file, node_ids, delimiter="\t", extra_columns=False):
+        self.output_file = output_file
+        self.node_ids = node_ids
+        self.delimiter = delimiter
+        self.extra_columns = extra_columns
+        self.n_clusters = 0
+        # seconds spent writing
+        self.elapsed = 0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.output = open(self.output_file, "w", buffering=WRITE_BUFFER_SIZE)
+        columns = ["node_id", "cluster_id"]
+        if self.extra_columns:
+            columns += ["k", "modularity"]
+        self.output.write(self.delimiter.join(columns) + "\n")
+        self.elapsed += time.perf_counter() - start
+        return self
+
+    def __exit__(self, *exc_info):
+        start = time.perf_counter()
+        self.output.close()
+        self.elapsed += time.perf_counter() - start
+        return False
+
+    def write(self, nodes, sizes, accepted, k, modularities):
+        """
+        Writes the clusters found at one level
+        nodes        : the (compact) node IDs of the level, grouped by component
+        sizes        : the number of nodes in each component
+        accepted     : which components are clusters
+        k            : the k of the level
+        modularities : the modularity of each component
+        """
+        start = time.perf_counter()
+        kept = accepted & (sizes > 1)
+        if kept.any():
+            nodes = nodes[np.repeat(kept, sizes)]
+            sizes = sizes[kept]
+            cluster_ids = np.arange(self.n_clusters + 1, self.n_clusters + len(sizes) + 1)
+            self.n_clusters += len(sizes)
+
+            block = {
+                "node_id": np.asarray(self.node_ids[nodes]),
+                "cluster_id": np.repeat(cluster_ids, sizes),
+            }
+            if self.extra_columns:
+                block["k"] = np.full(len(nodes), k)
+                block["modularity"] = np.repeat(modularities[kept], sizes)
+            pd.DataFrame(block).to_csv(
+                self.output, sep=self.delimiter, header=False, index=False
+            )
+        self.elapsed += time.perf_counter() - start
 
 
-def iterative_k_core_decomposition_MCS_ES(graph, k, inverted_orig_node_ids):
+def iterative_k_core_decomposition_MCS_ES(offsets, neighbors, writers, modularity_check=False):
     """
     INPUT
     -----
-    graph                  : the full networkit graph
-    k                      : the minimum allowed value for k for valid clusters
-    inverted_orig_node_ids : the dictionary mapping the compacted node IDs to the original node IDs
-    OUTPUT
-    ------
-    final_clusters : the clustering output, a list of lists with clustered nodes
+    offsets, neighbors : the full graph as an undirected CSR adjacency (see build_adjacency)
+    writers            : for every minimum allowed value of k for valid clusters, the ClusterWriter
+                         its clusters are written to as soon as they are found
+    modularity_check   : whether clusters must have a positive modularity
+
+    Every level clusters the maximum core of the remaining graph and removes it. The core numbers
+    of the remaining nodes are then lowered in place (see lower_core_numbers) instead of
+    decomposing the remaining graph again, and nodes keep their IDs throughout
+    The levels do not depend on k, which only decides where the run stops and which components
+    are valid, so the clusterings of several values of k are all derived from one pass
+    The run uses one core: the checks of a level are vectorized over all of its components, and
+    every level depends on the core numbers the previous one left
     """
-    orig_graph = nk.graphtools.subgraphFromNodes(graph, graph.iterNodes())
-    L = orig_graph.numberOfEdges()
-    singletons = []
-    final_clusters = []
-
-    nbr_failed_modularity = 0
-    nbr_failed_k_valid = 0
+    core = core_numbers(offsets, neighbors)
+    degrees = np.diff(offsets)
+    n = len(core)
+    alive = np.ones(n, dtype=bool)
+    # index in members of the nodes of the current core, -1 elsewhere
+    position = np.full(n, -1, dtype=np.int64)
+    n_alive = n
+    L = len(neighbors) // 2
+
+    nbr_failed_modularity = dict.fromkeys(writers, 0)
+    nbr_failed_k_valid = dict.fromkeys(writers, 0)
+
+    # bucket queue of the nodes by core number, with the count of remaining nodes in each bucket
+    # (nodes whose core number is lowered are added to their new bucket and skipped in the old one)
+    buckets = {}
+    _push(buckets, np.arange(n), core)
+    core_count = np.bincount(core, minlength=1)
+    max_k = len(core_count) - 1
 
     # continue finding clusters for different values of k until
     # a. there are no nodes left in the garph or
     # b. the maximum value of k is lower than the minumum allowed k for valid clusters
-    while graph.numberOfNodes() > 0:
+    while n_alive > 0:
 
-        # run kc on the graph to get the smallest kcore
-        subgraph, max_k, kcore = kc(graph)
-        if subgraph == None:
-            if not quiet:
-                print("no available subgraph")
-            break
+        # the maximum core of the remaining graph
+        while core_count[max_k] == 0:
+            max_k -= 1
+        members = np.concatenate(buckets.pop(max_k))
+        members = np.unique(members[alive[members] & (core[members] == max_k)])
+        if not quiet:
+            print("k value", max_k, "nbr core members", len(members))
 
-        # if b. above is true, add all singletons and nodes left in the graph as individual clusters
-        # and break
-        if max_k < k:
-            for node in graph.iterNodes():
-                modularity = (-1) * (
-                    orig_graph.degree(inverted_orig_node_ids[node]) / (2 * L)
-                ) ** 2
-                final_clusters.append(([inverted_orig_node_ids[node]], 0, modularity))
-            for node in singletons:
-                final_clusters.append(([node], 0, 0))
+        # if b. above is true (for every k), the nodes left in the graph stay unclustered
+        if max_k < min(writers):
             break
 
         # compute the components
-        cc = nk.components.WeaklyConnectedComponents(subgraph)
-        cc.run()
-        components = cc.getComponents()
-
-        nodes_to_remove = set()
-
-        # check components to make sure they are k-valid and m-valid
-        # then if so, add them to a cluster or break them up to make k-valid
-        # finally add them to the final_clusters and remove those nodes from the graph
-        for component in components:
-            clusters = []
-            valid_modularities = []
-
-            # ensure the component is k_valid and modular
-            # if not remode the nodes from the graph and add to the singletons
-            if k_valid(component, subgraph, k):
-                modularity = modular(component, orig_graph, inverted_orig_node_ids)
-                if modularity > 0:
-                    sub_components = [(component, modularity)]
-                else:
-                    if not quiet:
+        owner, member_neighbors = _gather(offsets, neighbors, members)
+        position[members] = np.arange(len(members))
+        targets = position[member_neighbors]
+        position[members] = -1
+        # the edges inside the core, between indices into members
+        inside = targets >= 0
+        edges = (owner[inside], targets[inside])
+        labels = component_labels(len(members), edges)
+        # the members grouped by component, in component order
+        grouped = members[np.argsort(labels, kind="stable")]
+        sizes = np.bincount(labels)
+        modularities = modular(labels, edges, degrees[members], L)
+
+        # check components to make sure they are k-valid and m-valid, write the valid ones out as
+        # clusters, and remove all nodes of the core from the graph either way
+        for k, writer in writers.items():
+            # the run for this k already stopped at an earlier level
+            if max_k < k:
+                continue
+            valid = k_valid(labels, edges, k)
+            accepted = valid & (modularities > 0) if modularity_check else valid
+            nbr_failed_k_valid[k] += np.count_nonzero(~valid)
+            nbr_failed_modularity[k] += np.count_nonzero(valid & ~accepted)
+            if not quiet:
+                for size, component_k_valid, component_accepted in zip(
+                    sizes.tolist(), valid.tolist(), accepted.tolist()
+                ):
+                    if not component_k_valid:
+                        print("failed k-valid")
+                    elif not component_accepted:
                         print("failed modularity")
-                    nbr_failed_modularity += 1
-                    sub_components = []
-                    nodes_to_remove.update(component)
-                    singletons.extend(
-                        orig_id_component(component, inverted_orig_node_ids)
-                    )
-            else:
-                if not quiet:
-                    print("failed k-valid")
-                nbr_failed_k_valid += 1
-                sub_components = []
-                nodes_to_remove.update(component)
-                singletons.extend(orig_id_component(component, inverted_orig_node_ids))
-
-            # retreive the original node ID for the clustering output and add each new component as its own cluster
-            for sub_component, modularity in sub_components:
-                nodes_to_remove.update(sub_component)
-                cluster = []
-                for node in sub_component:
-                    cluster.append(inverted_orig_node_ids[node])
-                if not quiet:
-                    print("adding cluster length", len(cluster))
-                clusters.append((cluster, max_k, modularity))
-
-            final_clusters.extend(clusters)
+                    else:
+                        print("adding cluster length", size)
+            writer.write(grouped, sizes, accepted, max_k, modularities)
 
         # just prints information about the number of components to standard output
-        component_sizes = cc.getComponentSizes()
-        nbr_large_components = 0
-        large_components = dict()
-        for nbr, size in component_sizes.items():
-            if size > 100:
-                nbr_large_components += 1
-                large_components[nbr] = size
         if not quiet:
             print(
                 "nbr components:",
-                len(components),
+                len(sizes),
                 ",  nbr components with more than 100 nodes:",
-                nbr_large_components,
+                np.count_nonzero(sizes > 100),
             )
 
-        # remove nodes marked for removal
-        # (either already clustered or when a large cluster is not validly broken up)
-        for node in nodes_to_remove:
-            graph.removeNode(node)
-            # print ("removing node: ", inverted_orig_node_ids[node])
-
-        # compact the subgraph with continuous node IDs (needed for partitioning in kc)
-        # and update inverted_orig_node_ids with the new IDs
-        node_id_dict = nk.graphtools.getContinuousNodeIds(graph)
-        inverted_node_id_dict = dict(map(reversed, node_id_dict.items()))
-        temp_dict = dict()
-        for new_id, old_id in inverted_node_id_dict.items():
-            orig_id = inverted_orig_node_ids[old_id]
-            temp_dict[new_id] = orig_id
-        inverted_orig_node_ids = temp_dict
-        graph = nk.graphtools.getCompactedGraph(graph, node_id_dict)
+        # remove the whole core (either clustered or when a large cluster is not validly broken up)
+        # and lower the core numbers of the nodes that lost neighbours
+        alive[members] = False
+        n_alive -= len(members)
+        core_count[max_k] -= len(members)
+        affected = np.unique(member_neighbors[alive[member_neighbors]])
+        lowered, previous = lower_core_numbers(offsets, neighbors, core, alive, affected)
+        np.subtract.at(core_count, previous, 1)
+        np.add.at(core_count, core[lowered], 1)
+        _push(buckets, lowered, core[lowered])
 
         if not quiet:
-            print("nodes left in graph: ", graph.numberOfNodes())
+            print("nodes left in graph: ", n_alive)
 
     if not quiet:
-        print(
-            "nbr of clusters which were rejected since they were not k-valid : ",
-            nbr_failed_k_valid,
-        )
-        print(
-            "nbr of clusters which were rejected since they were not modular : ",
-            nbr_failed_modularity,
-        )
-
-    return final_clusters
+        for k in writers:
+            suffix = f" (k = {k})" if len(writers) > 1 else ""
+            print(
+                f"nbr of clusters which were rejected since they were not k-valid{suffix} : ",
+                nbr_failed_k_valid[k],
+            )
+            print(
+                f"nbr of clusters which were rejected since they were not modular{suffix} : ",
+                nbr_failed_modularity[k],
+            )
 
 
-def kc(graph, k=None):
+def build_adjacency(sources, targets, n_nodes):
     """
-    INPUT
-    -----
-    graph : networkit graph
-    k     : the minimum node degree for all nodes in the subgraph
-    OUTPUT
-    ------
-    subgraph : the subgraph containing only nodes of degree k or higher
-    max_k    : the the largest value of k for which there are still nodes remaining in the subgraph
-    kc       : the core decomposition networkit object
+    Builds the undirected CSR adjacency of a graph from its edge arrays: the neighbours of node i
+    are neighbors[offsets[i]:offsets[i + 1]]
+    Self-loops and parallel edges (in either direction) are dropped, as in the edgelist spec, and
+    every remaining edge is listed at both of its endpoints
     """
-
-    # get the value of k associated with each node in the graph and store in a partition
-    kc = nk.centrality.CoreDecomposition(graph, storeNodeOrder=True)
-    kc.run()
-    partition = kc.getPartition()
-
-    kcore_members = []
-    max_k = kc.maxCoreNumber()
-
-    # default to the maximum k value
-    if k == None:
-        k = max_k
-
-    save_k = k
-
-    # if the value of k is lower than the minimum allowed exit
-    if max_k < k:
-        return None, max_k, kc
-
-    # populate the kcore members with all nodes with k values between k and max_k
-    while k <= max_k:
-        kcore_members.extend(partition.getMembers(k))
-        k += 1
-
-    # return the subgraph with nodes from kcore members
-    if not quiet:
-        print("k value", save_k, "nbr core members", len(kcore_members))
-    return nk.graphtools.subgraphFromNodes(graph, kcore_members), max_k, kc
-
-
-def k_valid(component, subgraph, k):
-    # subgraph = nk.graphtools.subgraphFromNodes(graph, component)
-    k_valid = True
-    component_nodes = set(component)
-    for node in subgraph.iterNodes():
-        if node in component_nodes:
-            if (subgraph.degreeIn(node) + subgraph.degreeOut(node)) < k:
-                # print ("node", node)
-                # print('fails k condition', subgraph.degree(node))
-                k_valid = False
-                break
-    return k_valid
-
-
-def modular(component, orig_graph, inverted_orig_node_ids):
-    POSITIVE_VALUE = 1
-    return POSITIVE_VALUE
-
-    cluster = nk.graphtools.subgraphFromNodes(
-        orig_graph, orig_id_component(component, inverted_orig_node_ids)
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    low, high = np.minimum(sources, targets), np.maximum(sources, targets)
+    keep = low != high
+    # one integer key per undirected edge, so duplicates go away in a single sort
+    low, high = np.divmod(np.unique(low[keep] * n_nodes + high[keep]), n_nodes)
+
+    ends = np.concatenate((low, high))
+    others = np.concatenate((high, low))
+    order = np.argsort(ends, kind="stable")
+    offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ends, minlength=n_nodes), out=offsets[1:])
+    node_dtype = np.int32 if n_nodes <= np.iinfo(np.int32).max else np.int64
+    return offsets, others[order].astype(node_dtype)
+
+
+def core_numbers(offsets, neighbors):
+    """The core number of every node, by networkit's core decomposition of the CSR adjacency"""
+    n = len(offsets) - 1
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    sources = np.repeat(np.arange(n, dtype=np.uint64), np.diff(offsets))
+    targets = neighbors.astype(np.uint64)
+    # every edge once, networkit adds both directions of an undirected edge
+    once = sources < targets
+    graph = nk.GraphFromCoo((sources[once], targets[once]), n)
+    decomposition = nk.centrality.CoreDecomposition(graph)
+    decomposition.run()
+    return np.asarray(decomposition.scores(), dtype=np.int64)
+
+
+def lower_core_numbers(offsets, neighbors, core, alive, dirty):
+    """
+    Lowers the core numbers of the remaining (alive) nodes in place after nodes were removed
+    dirty : the remaining nodes that lost neighbours
+    The current core numbers are upper bounds of the new ones, so they are lowered to the h-index
+    of their neighbours' core numbers until nothing changes. Only nodes with a lowered neighbour
+    are looked at again: all at once while there are many of them, and one at a time from a queue
+    once there are few, so that a change travelling down a long chain of nodes costs one step per
+    node rather than one pass over all the looked-at nodes per hop
+    Returns the nodes whose core number was lowered and their previous core numbers
+    """
+    lowered_nodes = []
+    previous_cores = []
+    while len(dirty) >= PEEL_BATCH_SIZE:
+        owner, values = _gather(offsets, neighbors, dirty)
+        # removed neighbours do not count, and no neighbour counts for more than the node's own core
+        values = np.where(alive[values], core[values], 0)
+        values = np.minimum(values, core[dirty][owner])
+
+        # h-index of every dirty node: the number of ranks i at which its i-th largest value is >= i
+        order = np.lexsort((-values, owner))
+        counts = np.bincount(owner, minlength=len(dirty))
+        rank = np.arange(1, len(values) + 1) - np.repeat(np.cumsum(counts) - counts, counts)
+        h_index = np.bincount(
+            owner[order], weights=values[order] >= rank, minlength=len(dirty)
+        ).astype(np.int64)
+
+        lowered = h_index < core[dirty]
+        changed, new_core = dirty[lowered], h_index[lowered]
+        lowered_nodes.append(changed)
+        previous_cores.append(core[changed])
+        core[changed] = new_core
+
+        # neighbours whose own core number exceeds the new one of a changed node may be lowered too
+        owner, values = _gather(offsets, neighbors, changed)
+        keep = alive[values]
+        owner, values = owner[keep], values[keep]
+        dirty = np.unique(values[core[values] > new_core[owner]])
+
+    # the same one node at a time, on python scalars
+    queue = collections.deque(dirty.tolist())
+    queued = set(queue)
+    while queue:
+        node = queue.popleft()
+        queued.discard(node)
+        node_core = int(core[node])
+        adjacent = [
+            neighbor
+            for neighbor in neighbors[offsets[node] : offsets[node + 1]].tolist()
+            if alive[neighbor]
+        ]
+        values = sorted((min(int(core[neighbor]), node_core) for neighbor in adjacent), reverse=True)
+        h_index = 0
+        while h_index < len(values) and values[h_index] > h_index:
+            h_index += 1
+        if h_index == node_core:
+            continue
+        lowered_nodes.append([node])
+        previous_cores.append([node_core])
+        core[node] = h_index
+        for neighbor in adjacent:
+            if core[neighbor] > h_index and neighbor not in queued:
+                queue.append(neighbor)
+                queued.add(neighbor)
+
+    if len(lowered_nodes) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # a node lowered several times keeps its first, highest, previous core number
+    lowered_nodes = np.concatenate(lowered_nodes).astype(np.int64)
+    previous_cores = np.concatenate(previous_cores).astype(np.int64)
+    order = np.lexsort((-previous_cores, lowered_nodes))
+    lowered_nodes, previous_cores = lowered_nodes[order], previous_cores[order]
+    first = np.r_[True, lowered_nodes[1:] != lowered_nodes[:-1]]
+    return lowered_nodes[first], previous_cores[first]
+
+
+def component_labels(n_nodes, edges):
+    """
+    Labels the connected components of a graph given as an edge array
+    Components are numbered by their smallest node
+    """
+    sources, targets = edges
+    adjacency = sp.csr_matrix(
+        (np.ones(len(sources), dtype=np.int8), (sources, targets)),
+        shape=(n_nodes, n_nodes),
     )
+    n_components, labels = csgraph.connected_components(adjacency, directed=False)
 
-    l = orig_graph.numberOfEdges()
-    ls = cluster.numberOfEdges()
-    ds = 0
+    _, first = np.unique(labels, return_index=True)
+    rank = np.empty(n_components, dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(n_components)
+    return rank[labels]
 
-    for node in cluster.iterNodes():
-        ds += orig_graph.degreeIn(node)
-        ds += orig_graph.degreeOut(node)
-
-    return ls / l - (ds / (2 * l)) ** 2
 
+def k_valid(labels, edges, k):
+    """
+    Checks all the components of a core at once: a component is k-valid when every node in it has
+    at least k neighbours in the same component
+    labels : the component of every node of the core
+    edges  : the edges inside the core, listed from both ends (see component_labels)
+    Returns a boolean array over the components
+    """
+    sources, targets = edges
+    same = labels[sources] == labels[targets]
+    degrees = np.bincount(sources[same], minlength=len(labels))
+    min_degrees = np.full(labels.max() + 1, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(min_degrees, labels, degrees)
+    return min_degrees >= k
 
-def orig_id_component(component, inverted_orig_node_ids):
-    return [inverted_orig_node_ids[node] for node in component]
 
+def modular(labels, edges, degrees, L):
+    """
+    Modularity of all the components of a core at once: ls / L - (ds / 2L)^2, where ls is the
+    number of edges inside the component, ds the total degree of its nodes in the full graph and L
+    the number of edges in the full graph
+    labels  : the component of every node of the core
+    edges   : the edges inside the core, listed from both ends (see component_labels)
+    degrees : the degree in the full graph of every node of the core
+    Returns a float array over the components
+    """
+    sources, targets = edges
+    n_components = labels.max() + 1
+    if L == 0:
+        return np.zeros(n_components)
+    same = labels[sources] == labels[targets]
+    ls = np.bincount(labels[sources[same]], minlength=n_components) / 2
+    ds = np.bincount(labels, weights=degrees, minlength=n_components)
+    return ls / L - (ds / (2 * L)) ** 2
 
-def format_graph(graph1):
-    origNodeIdDict = nk.graphtools.getContinuousNodeIds(graph1)
-    invertedOrigNodeIdDict = dict(map(reversed, origNodeIdDict.items()))
-    graph1 = nk.graphtools.getCompactedGraph(graph1, origNodeIdDict)
 
-    if graph1.isWeighted() == False:
-        if not quiet:
-            print("not weighted")
-        weighted = nk.Graph(n=0, weighted=True, directed=True)
-
-        for node in graph1.iterNodes():
-            weighted.addNode()
-        for u, v in graph1.iterEdges():
-            if weighted.hasNode(u) == False:
-                weighted.addNode(u)
-            if weighted.hasNode(v) == False:
-                weighted.addNode(v)
-            weighted.addEdge(u, v, graph1.degreeIn(u))
-            # print (u, v, graph1.degreeIn(u))
-        graph = weighted
-    else:
-        graph = graph1
+def _gather(offsets, neighbors, nodes):
+    """
+    Returns the neighbours of the given nodes, concatenated, along with the index in nodes of the
+    node each of them is a neighbour of
+    """
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    owner = np.repeat(np.arange(len(nodes)), counts)
+    positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return owner, neighbors[positions]
 
-    graph.removeSelfLoops()
 
-    if not quiet:
-        print(graph.numberOfNodes())
-    return graph, invertedOrigNodeIdDict
+def _push(buckets, nodes, cores):
+    """Adds nodes to the buckets of their core numbers"""
+    order = np.argsort(cores, kind="stable")
+    values, starts = np.unique(cores[order], return_index=True)
+    for value, group in zip(values.tolist(), np.split(nodes[order], starts[1:])):
+        buckets.setdefault(value, []).append(group)
 
 
 def parseArgs():
@@ -360,7 +508,8 @@ def parseArgs():
         "-o",
         "--output",
         type=str,
-        help="Path to file containing output",
+        nargs="+",
+        help="Path to file containing output, or one path per value of k",
         required=True,
         default=None,
     )
@@ -368,16 +517,36 @@ def parseArgs():
     parser.add_argument(
         "-k",
         "--kvalue",
-        type=int,
-        help="non-negative integer value of the minimum required adjacent nodes for each node",
+        type=lambda value: [int(k) for k in value.split(",")],
+        help="non-negative integer value of the minimum required adjacent nodes for each node, or several comma-separated values (e.g. 5,10,20) to derive the clustering of each from one run",
         required=False,
-        default=0,
+        default=[0],
     )
 
     parser.add_argument(
         "-q", "--quiet", action="store_true", help="silence ikc outputs"
     )
 
+    parser.add_argument(
+        "--modularity-check",
+        action="store_true",
+        help="only keep clusters with a positive modularity",
+    )
+
+    parser.add_argument(
+        "--extra-columns",
+        action="store_true",
+        help="also write the k and modularity of each cluster",
+    )
+
+    parser.add_argument(
+        "--graph-cache",
+        type=str,
+        help="Directory of the parsed graph cache shared across pipeline stages",
+        required=False,
+        default=None,
+    )
+
     parser.add_argument(
         "-v",
         "--version",
@@ -390,4 +559,5 @@ def parseArgs():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     main(parseArgs())
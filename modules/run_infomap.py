@@ -1,10 +1,20 @@
+import sys
 import time
 import logging
 import argparse
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 from infomap import Infomap
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from toolkit import graph_cache, forkpool
+from toolkit.sniff import get_delimiter
+
+# Seed of the first trial, infomap's own default
+DEFAULT_SEED = 123
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -20,73 +30,164 @@ def parse_args():
         required=True,
         help="Path to the output file",
     )
+    parser.add_argument(
+        "--trials",
+        type=int,
+        default=1,
+        help="Number of trials, the one with the lowest codelength is kept (default: 1)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=DEFAULT_SEED,
+        help=f"Seed of the first trial, trial i uses seed + i (default: {DEFAULT_SEED})",
+    )
+    parser.add_argument(
+        "--two-level",
+        action="store_true",
+        help="Find a two-level partition instead of a module hierarchy",
+    )
+    parser.add_argument(
+        "--directed",
+        action="store_true",
+        help="Model the flow along the edges from source to target",
+    )
+    parser.add_argument(
+        "--time-limit",
+        type=float,
+        default=None,
+        help="Seconds after which no new trial starts",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes running the trials (default: number of cores)",
+    )
+    parser.add_argument(
+        "--module-path",
+        action="store_true",
+        help="Also write the path of every node's module in the hierarchy, e.g. 1:3:2",
+    )
+    parser.add_argument(
+        "--graph-cache",
+        type=str,
+        default=None,
+        help="Directory of the parsed graph cache shared across pipeline stages",
+    )
     args = parser.parse_args()
     return args
 
 
-args = parse_args()
-
-args = parse_args()
-edgelist_fn = args.edgelist
-output_file = Path(args.output)
-
-
-# delimiter checking
-def get_delimiter(filepath: str) -> str:
-    with open(filepath, "r") as f:
-        for current_line in f:
-            if "," in current_line:
-                return ","
-            elif " " in current_line:
-                return " "
-            elif "\t" in current_line:
-                return "\t"
-            else:
-                raise ValueError(
-                    "Unsupported delimiter: delimiter must be either comma, tab, or whitespace."
-                )
-
-
-# ===========
-
-start = time.perf_counter()
-
-im = Infomap()
-delimiter = get_delimiter(edgelist_fn)
-with open(edgelist_fn) as f:
-    f.readline()  # skip header
-    for line in f:
-        u, v = line.split(sep=delimiter)
-        im.add_link(int(u), int(v))
-
-elapsed = time.perf_counter() - start
-logging.info(f"[TIME] Loading network: {elapsed}")
-
-# ===========
-
-start = time.perf_counter()
-
-im.run()
-
-elapsed = time.perf_counter() - start
-logging.info(f"[TIME] Running Infomap algorithm: {elapsed}")
-
-# ===========
-
-start = time.perf_counter()
-
-cluster_dict = {}
-for node in im.tree:
-    if node.is_leaf:
-        if node.module_id not in cluster_dict:
-            cluster_dict[node.module_id] = []
-        cluster_dict[node.module_id].append(node.node_id)
-
-with open(output_file, "w") as f:
-    f.write(f"node_id{delimiter}cluster_id\n")  # write header
-    for key in cluster_dict:
-        for val in cluster_dict[key]:
-            f.write(f"{val}{delimiter}{key}\n")
+def run_infomap(
+    edgelist_fn,
+    output_file,
+    graph=None,
+    cache_dir=None,
+    trials=1,
+    seed=DEFAULT_SEED,
+    two_level=False,
+    directed=False,
+    time_limit=None,
+    workers=None,
+    module_path=False,
+):
+    """Run Infomap on `edgelist_fn` and write the clustering to `output_file`.
+
+    Every trial runs with its own seed (`seed`, `seed` + 1, ...) on up to
+    `workers` forked processes (default: one per core), and the partition with
+    the lowest codelength is kept. With a `time_limit` (seconds), no new trial
+    starts once it is spent. With `module_path`, the output also has the path of
+    every node's module in the hierarchy.
+
+    `graph` and `cache_dir`: see graph_cache.load_graph.
+    """
+    output_file = Path(output_file)
+
+    # ===========
+
+    start = time.perf_counter()
+
+    im = Infomap(two_level=two_level, directed=directed, silent=True)
+    delimiter = get_delimiter(edgelist_fn)
+    if graph is None:
+        graph = graph_cache.load_graph(edgelist_fn, cache_dir)
+    # all links at once, through infomap's native reader of numpy edge arrays
+    im.add_links(graph.edge_array())
+    node_ids = graph.node_ids
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"[TIME] Loading network: {elapsed}")
+
+    # ===========
+
+    start = time.perf_counter()
+
+    results = forkpool.map_forked(
+        _run_trial,
+        dict(infomap=im, module_path=module_path),
+        [seed + trial for trial in range(trials)],
+        workers,
+        time_limit,
+    )
+    best = min(results, key=lambda result: result["codelength"])
+    logging.info(
+        f"Best codelength {best['codelength']} (seed {best['seed']}) of {len(results)} trials"
+    )
 
-elapsed = time.perf_counter() - start
-logging.info(f"[TIME] Saving results: {elapsed}")
+    elapsed = time.perf_counter() - start
+    logging.info(f"[TIME] Running Infomap algorithm: {elapsed}")
+
+    # ===========
+
+    start = time.perf_counter()
+
+    # the top-level module of every node, written grouped by module
+    order = np.argsort(best["modules"], kind="stable")
+    block = {
+        "node_id": np.asarray(node_ids)[best["nodes"][order]],
+        "cluster_id": best["modules"][order],
+    }
+    if module_path:
+        block["module_path"] = best["paths"][order]
+    pd.DataFrame(block).to_csv(output_file, sep=delimiter, header=True, index=False)
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"[TIME] Saving results: {elapsed}")
+
+
+def _run_trial(trial_seed):
+    """Runs Infomap on the shared network with one seed and returns its partition"""
+    im = forkpool.shared["infomap"]
+    im.run(seed=trial_seed, num_trials=1)
+
+    nodes, modules = np.array(list(im.modules), dtype=np.int64).reshape(-1, 2).T
+    result = {
+        "seed": trial_seed,
+        "codelength": im.codelength,
+        "nodes": nodes,
+        "modules": modules,
+    }
+    if forkpool.shared["module_path"]:
+        multilevel = im.get_multilevel_modules()
+        result["paths"] = np.array(
+            [":".join(map(str, multilevel[node])) for node in nodes.tolist()], dtype=object
+        )
+    return result
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    run_infomap(
+        args.edgelist,
+        args.output,
+        cache_dir=args.graph_cache,
+        trials=args.trials,
+        seed=args.seed,
+        two_level=args.two_level,
+        directed=args.directed,
+        time_limit=args.time_limit,
+        workers=args.workers,
+        module_path=args.module_path,
+    )
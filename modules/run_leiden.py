@@ -1,24 +1,19 @@
+import os
+import sys
 import argparse
+import itertools
 import leidenalg as la
 import igraph as ig
 import logging
 import time
+import numpy as np
 import pandas as pd
+from pathlib import Path
 
-
-def get_delimiter(filepath: str) -> str:
-    with open(filepath, "r") as f:
-        for current_line in f:
-            if "," in current_line:
-                return ","
-            elif " " in current_line:
-                return " "
-            elif "\t" in current_line:
-                return "\t"
-            else:
-                raise ValueError(
-                    "Unsupported delimiter: delimiter must be either comma, tab, or whitespace."
-                )
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from toolkit import graph_cache, forkpool
+from toolkit.sniff import get_delimiter, check_header
+from toolkit.conversion_toolkit import is_columnar, read_columnar
 
 
 # TODO: Credits to DSC run_leiden.py and CM-pipeline scripts
@@ -29,15 +24,53 @@ def run_leiden(
     resolution=None,
     n_iters=2,
     seed=1234,
+    graph=None,
+    cache_dir=None,
+    workers=None,
+    initial_membership=None,
+    time_budget=None,
 ):
+    """Run Leiden on `edgelist_path` and write the clustering to `output_path`.
+
+    With `initial_membership` (a clustering file), Leiden starts from that
+    clustering instead of singletons, nodes it does not cover starting alone.
+    With a `time_budget` (seconds), no new iteration starts once it is spent.
+    A negative `n_iters` iterates until an iteration no longer improves the
+    partition.
+
+    `resolution` and `seed` may also be lists: every combination is then run on
+    the network loaded once, on up to `workers` forked processes (default: one
+    per core), each writing its clustering next to `output_path` (see
+    sweep_outputs), and a summary of the cluster count and quality of every
+    combination is written to <output_path stem>-summary.csv.
+
+    `graph` and `cache_dir`: see graph_cache.load_graph.
+    """
+    if isinstance(resolution, (list, tuple)) or isinstance(seed, (list, tuple)):
+        run_leiden_sweep(
+            edgelist_path,
+            output_path,
+            model,
+            resolution,
+            n_iters,
+            seed,
+            graph=graph,
+            cache_dir=cache_dir,
+            workers=workers,
+            initial_membership=initial_membership,
+            time_budget=time_budget,
+        )
+        return
+
     # Read in leiden
     start = time.perf_counter()
 
     delimiter = get_delimiter(edgelist_path)
-    df = pd.read_csv(edgelist_path, sep=delimiter)
-    g = ig.Graph.TupleList(
-        df.itertuples(index=False), directed=False, vertex_name_attr="name"
-    )
+    if graph is None:
+        graph = graph_cache.load_graph(edgelist_path, cache_dir)
+    g = build_igraph(graph)
+    if initial_membership is not None:
+        initial_membership = read_membership(initial_membership, graph.node_ids)
 
     elapsed = time.perf_counter() - start
     logging.info(f"[TIME] Loading network: {elapsed}")
@@ -45,40 +78,231 @@ def run_leiden(
     # Running leiden
     start = time.perf_counter()
 
+    partition = find_partition(
+        g, model, resolution, seed, n_iters, initial_membership, time_budget
+    )
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"[TIME] Running Leiden algorithm: {elapsed}")
+
+    # Output
+    start = time.perf_counter()
+
+    save_partition(graph.node_ids, partition, output_path, delimiter)
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"[TIME] Saving results: {elapsed}")
+
+
+def run_leiden_sweep(
+    edgelist_path,
+    output_path,
+    model="cpm",
+    resolutions=None,
+    n_iters=2,
+    seeds=1234,
+    graph=None,
+    cache_dir=None,
+    workers=None,
+    initial_membership=None,
+    time_budget=None,
+):
+    """Run Leiden with every combination of `resolutions` and `seeds` (each a value or a list) on
+    the network loaded once, see run_leiden"""
+    combinations = [
+        (resolution, seed, path)
+        for (resolution, seed), path in sweep_outputs(output_path, resolutions, seeds).items()
+    ]
+
+    # Read in leiden
+    start = time.perf_counter()
+
+    delimiter = get_delimiter(edgelist_path)
+    if graph is None:
+        graph = graph_cache.load_graph(edgelist_path, cache_dir)
+    g = build_igraph(graph)
+    if initial_membership is not None:
+        initial_membership = read_membership(initial_membership, graph.node_ids)
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"[TIME] Loading network: {elapsed}")
+
+    # Running leiden, each combination also writes its own clustering
+    sweep = dict(
+        graph=g,
+        node_ids=graph.node_ids,
+        model=model,
+        n_iters=n_iters,
+        delimiter=delimiter,
+        initial_membership=initial_membership,
+        time_budget=time_budget,
+    )
+    rows = forkpool.map_forked(_run_combination, sweep, combinations, workers)
+
+    # times summed over the combinations
+    logging.info(
+        f"[TIME] Running Leiden algorithm: {sum(row.pop('run_time') for row in rows)}"
+    )
+    saving = sum(row.pop("save_time") for row in rows)
+
+    # Output
+    start = time.perf_counter()
+
+    summary_path = "{}-summary{}".format(*os.path.splitext(output_path))
+    pd.DataFrame(rows).to_csv(summary_path, index=False, sep=delimiter, header=True)
+
+    elapsed = time.perf_counter() - start
+    logging.info(f"[TIME] Saving results: {saving + elapsed}")
+
+
+def sweep_outputs(output_path, resolutions, seeds):
+    """
+    Output path of every (resolution, seed) combination: output_path suffixed with the values of
+    the parameters given as lists, e.g. out.csv becomes out-res=0.1.seed=1.csv
+    """
+    stem, extension = os.path.splitext(output_path)
+    outputs = {}
+    for resolution, seed in itertools.product(_as_list(resolutions), _as_list(seeds)):
+        suffixes = []
+        if isinstance(resolutions, (list, tuple)):
+            suffixes.append(f"res={resolution}")
+        if isinstance(seeds, (list, tuple)):
+            suffixes.append(f"seed={seed}")
+        outputs[resolution, seed] = f"{stem}-{'.'.join(suffixes)}{extension}"
+    return outputs
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _run_combination(combination):
+    """Runs one combination of a sweep on the shared graph and returns its summary row"""
+    resolution, seed, output_path = combination
+    sweep = forkpool.shared
+
+    start = time.perf_counter()
+    partition = find_partition(
+        sweep["graph"],
+        sweep["model"],
+        resolution,
+        seed,
+        sweep["n_iters"],
+        sweep["initial_membership"],
+        sweep["time_budget"],
+    )
+    run_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    save_partition(sweep["node_ids"], partition, output_path, sweep["delimiter"])
+    save_time = time.perf_counter() - start
+
+    return {
+        "resolution": resolution,
+        "seed": seed,
+        "n_clusters": len(partition),
+        "quality": partition.quality(),
+        "output": output_path,
+        "run_time": run_time,
+        "save_time": save_time,
+    }
+
+
+def build_igraph(graph):
+    """
+    The undirected igraph of a CachedGraph, whose vertices are its compact node IDs
+    The edges are handed over in one call as pairs of Python ints, which igraph converts much
+    faster than rows of a numpy array
+    """
+    sources = graph.sources().tolist()
+    targets = np.asarray(graph.targets).tolist()
+    return ig.Graph(n=graph.n_nodes, edges=zip(sources, targets), directed=False)
+
+
+def find_partition(
+    g, model, resolution, seed, n_iters, initial_membership=None, time_budget=None
+):
     if model == "cpm":
-        partition = la.find_partition(
-            g,
-            la.CPMVertexPartition,
-            resolution_parameter=resolution,
-            seed=seed,
-            n_iterations=n_iters,
-        )
+        partition_type, arguments = la.CPMVertexPartition, {"resolution_parameter": resolution}
     elif model == "mod":
-        partition = la.find_partition(
-            g, la.ModularityVertexPartition, seed=seed, n_iterations=n_iters
-        )
+        partition_type, arguments = la.ModularityVertexPartition, {}
     else:
         raise ValueError(f"Unknown leiden model: {model}")
 
-    elapsed = time.perf_counter() - start
-    logging.info(f"[TIME] Running Leiden algorithm: {elapsed}")
+    if initial_membership is None and time_budget is None:
+        return la.find_partition(
+            g, partition_type, seed=seed, n_iterations=n_iters, **arguments
+        )
 
-    # Output
+    # one iteration at a time, to stop on convergence or once the time budget is spent
     start = time.perf_counter()
+    partition = partition_type(g, initial_membership=initial_membership, **arguments)
+    optimiser = la.Optimiser()
+    if seed is not None:
+        optimiser.set_rng_seed(seed)
+    iteration = 0
+    while n_iters < 0 or iteration < n_iters:
+        improvement = optimiser.optimise_partition(partition, n_iterations=1)
+        iteration += 1
+        if improvement <= 0:
+            break
+        if time_budget is not None and time.perf_counter() - start >= time_budget:
+            logging.info(f"Leiden stopped after {iteration} iterations, time budget spent")
+            break
+    return partition
+
+
+def read_membership(cluster_file, node_ids):
+    """
+    Reads a clustering as the initial cluster of every vertex, in the order of node_ids
+    Nodes of the clustering that are not in the graph are ignored, a node in several clusters
+    starts in the first one, and nodes in no cluster start in a cluster of their own
+    """
+    node_ids = np.asarray(node_ids)
+    if is_columnar(cluster_file):
+        columns, dictionary = read_columnar(cluster_file)
+        nodes, clusters = columns["node_id"], columns["cluster_id"]
+        if dictionary is not None:
+            nodes = dictionary[nodes]
+    else:
+        delimiter = get_delimiter(cluster_file)
+        has_header, _ = check_header(cluster_file, delimiter)
+        df = pd.read_csv(
+            cluster_file,
+            sep=delimiter,
+            header=0 if has_header else None,
+            usecols=[0, 1],
+            dtype={0: str} if node_ids.dtype.kind == "U" else None,
+        )
+        nodes, clusters = df.iloc[:, 0].to_numpy(), df.iloc[:, 1].to_numpy()
+    if node_ids.dtype.kind == "U":
+        nodes = np.asarray(nodes).astype(str)
+
+    vertices = pd.Index(node_ids).get_indexer(nodes)
+    found = vertices >= 0
+    vertices = vertices[found]
+    cluster_codes, _ = pd.factorize(clusters[found])
+
+    membership = np.full(len(node_ids), -1, dtype=np.int64)
+    vertices, first = np.unique(vertices, return_index=True)
+    membership[vertices] = cluster_codes[first]
+    alone = membership < 0
+    membership[alone] = np.arange(alone.sum()) + cluster_codes.max(initial=-1) + 1
+    return membership.tolist()
 
+
+def save_partition(node_ids, partition, output_path, delimiter):
+    """Writes the cluster of every node, mapping the vertices back through the node-id table"""
     df2 = pd.DataFrame(
         {
-            "node_id": [g.vs[i]["name"] for i in g.vs.indices],
-            "cluster_id": partition.membership,
+            "node_id": np.asarray(node_ids),
+            "cluster_id": np.asarray(partition.membership),
         }
     )
     df2.to_csv(
         output_path, index=False, sep=delimiter, header=True
     )  # TODO: file format
 
-    elapsed = time.perf_counter() - start
-    logging.info(f"[TIME] Saving results: {elapsed}")
-
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -113,9 +337,9 @@ if __name__ == "__main__":
         "-r",
         "--resolution",
         metavar="resolution",
-        type=float,
+        type=lambda value: [float(r) for r in value.split(",")],
         default=None,
-        help="Resolution parameter for the CPM model (default: None)",
+        help="Resolution parameter for the CPM model (default: None), or several comma-separated values to run each",
     )
 
     parser.add_argument(
@@ -123,7 +347,7 @@ if __name__ == "__main__":
         "--n-iterations",
         metavar="n_iteration",
         type=int,
-        help="Number of iterations for the Leiden algorithm (default: 2)",
+        help="Number of iterations for the Leiden algorithm, negative to iterate until convergence (default: 2)",
         default=2,
     )
 
@@ -132,18 +356,54 @@ if __name__ == "__main__":
         "-s",
         "--seed",
         metavar="seed",
+        type=lambda value: [int(s) for s in value.split(",")],
+        default=[1234],
+        help="Seed used for execution, or several comma-separated seeds to run each",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="workers",
         type=int,
-        default=1234,
-        help="Seed used for execution",
+        default=None,
+        help="Number of processes running the combinations of several resolutions and seeds (default: number of cores)",
+    )
+    parser.add_argument(
+        "--initial-membership",
+        metavar="initial_membership",
+        type=str,
+        default=None,
+        help="Clustering file Leiden starts from, instead of singletons",
+    )
+    parser.add_argument(
+        "--time-budget",
+        metavar="time_budget",
+        type=float,
+        default=None,
+        help="Seconds after which no new Leiden iteration starts",
+    )
+    parser.add_argument(
+        "--graph-cache",
+        metavar="graph_cache",
+        type=str,
+        default=None,
+        help="Directory of the parsed graph cache shared across pipeline stages",
     )
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
+    # a single value is passed as is, keeping the output path unchanged
+    single = lambda values: values[0] if values is not None and len(values) == 1 else values
     run_leiden(
         args.edgelist,
         args.output,
         args.model,
-        args.resolution,
+        single(args.resolution),
         args.n_iterations,
-        args.seed,
+        single(args.seed),
+        cache_dir=args.graph_cache,
+        workers=args.workers,
+        initial_membership=args.initial_membership,
+        time_budget=args.time_budget,
     )
@@ -2,8 +2,140 @@
 # sets n_iterations to 5 and seed to 1234
 # 2/19/2023
 
+import os
+import sys
 import graph_tool.all as gt
+import logging
 import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from toolkit import graph_cache, forkpool
+
+# Block states run_sbm supports
+BLOCK_STATES = ["non_nested_sbm", "planted_partition_model", "nested_sbm"]
+
+
+def run_sbm(
+    edgelist,
+    output,
+    block_state,
+    degree_corrected=False,
+    graph=None,
+    cache_dir=None,
+    threads=None,
+    n_runs=1,
+    workers=None,
+    seed=None,
+    refine_sweeps=0,
+    anneal=False,
+):
+    """Run SBM on `edgelist` and write the block membership to `output`.
+
+    graph-tool runs its parallel loops on `threads` OpenMP threads (default: one
+    per core, shared among the runs).
+
+    `n_runs` independent minimizations run on up to `workers` forked processes
+    (default: one per core), run i seeded with `seed` + i, and the state with the
+    lowest entropy (description length) is kept. Each state is then refined
+    with `refine_sweeps` zero-temperature merge-split MCMC sweeps, or with
+    `anneal`, simulated annealing over as many sweeps.
+
+    `graph` and `cache_dir`: see graph_cache.load_graph.
+    """
+    if block_state not in BLOCK_STATES:
+        raise ValueError(f"Unknown block state: {block_state}")
+    workers = min(workers or os.cpu_count(), n_runs)
+    threads = threads or max(1, os.cpu_count() // workers)
+    gt.openmp_set_num_threads(threads)
+    sbm_graph = gt.Graph(directed=False)
+
+    # the cached graph holds compact integer node IDs, added as one int array without hashing
+    if graph is None:
+        graph = graph_cache.load_graph(edgelist, cache_dir)
+    sbm_graph.add_vertex(graph.n_nodes)
+    sbm_graph.add_edge_list(graph.edge_array())
+    node_ids = graph.node_ids
+
+    # without a seed, a single run keeps graph-tool's own seeding, and several runs get random ones
+    if seed is None and n_runs > 1:
+        seed = int.from_bytes(os.urandom(4), "little") >> 1
+    seeds = [None if seed is None else seed + run for run in range(n_runs)]
+
+    runs = dict(
+        graph=sbm_graph,
+        block_state=block_state,
+        degree_corrected=degree_corrected,
+        threads=threads,
+        refine_sweeps=refine_sweeps,
+        anneal=anneal,
+    )
+    results = forkpool.map_forked(_run_once, runs, seeds, workers)
+    best = min(results, key=lambda result: result["entropy"])
+    if n_runs > 1:
+        logging.info(
+            f"Lowest entropy {best['entropy']} (seed {best['seed']}) of {n_runs} runs"
+        )
+
+    # vertices are the compact node IDs, so the block array lines up with the node-id table
+    pd.DataFrame(
+        {"node_id": np.asarray(node_ids), "cluster_id": best["blocks"]}
+    ).to_csv(output, sep=",", header=True, index=False)
+
+
+def _run_once(run_seed):
+    """Minimizes (and refines) one block state of the shared graph, returns its entropy and blocks"""
+    runs = forkpool.shared
+    gt.openmp_set_num_threads(runs["threads"])
+    if run_seed is not None:
+        gt.seed_rng(run_seed)
+        np.random.seed(run_seed)
+
+    state = minimize(runs["graph"], runs["block_state"], runs["degree_corrected"])
+    if runs["refine_sweeps"] > 0:
+        refine(state, runs["refine_sweeps"], runs["anneal"])
+
+    if runs["block_state"] == "nested_sbm":
+        blocks = state.get_levels()[0].get_blocks()
+    else:
+        blocks = state.get_blocks()
+    return {"seed": run_seed, "entropy": state.entropy(), "blocks": np.array(blocks.a)}
+
+
+def minimize(sbm_graph, block_state, degree_corrected=False):
+    if block_state == "non_nested_sbm":
+        return gt.minimize_blockmodel_dl(
+            sbm_graph, state=gt.BlockState, state_args={"deg_corr": degree_corrected}
+        )
+    elif block_state == "planted_partition_model":
+        return gt.minimize_blockmodel_dl(sbm_graph, state=gt.PPBlockState)
+    elif block_state == "nested_sbm":
+        return gt.minimize_nested_blockmodel_dl(
+            sbm_graph, state_args={"deg_corr": degree_corrected}
+        )
+    else:
+        raise ValueError(f"Unknown block state: {block_state}")
+
+
+def refine(state, sweeps, anneal=False):
+    """
+    Refines a minimized state in place with merge-split MCMC sweeps, either at zero temperature
+    (only moves lowering the entropy) or, with anneal, cooling from beta 1 to 10
+    Either way about `sweeps` sweeps are run in total (one per temperature step when annealing)
+    """
+    if anneal:
+        # one temperature step per sweep, each running a single sweep (the default niter of a sweep)
+        gt.mcmc_anneal(
+            state,
+            beta_range=(1, 10),
+            niter=sweeps,
+            mcmc_equilibrate_args=dict(force_niter=1),
+        )
+    else:
+        state.multiflip_mcmc_sweep(beta=np.inf, niter=sweeps)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script for running sbm.")
@@ -20,15 +152,56 @@ if __name__ == "__main__":
         metavar="block_state",
         type=str,
         required=True,
-        help="non_nested_sbm or planted_partition_model",
+        help="non_nested_sbm, planted_partition_model or nested_sbm",
     )
     parser.add_argument(
         "-d",
-        metavar="degree_corrected",
-        type=bool,
-        required=False,
+        "--degree-corrected",
+        action="store_true",
         help="whether to run degree corrected or not",
     )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        metavar="threads",
+        type=int,
+        required=False,
+        default=None,
+        help="number of OpenMP threads used by graph-tool (default: number of cores, shared among the runs)",
+    )
+    parser.add_argument(
+        "--n-runs",
+        metavar="n_runs",
+        type=int,
+        default=1,
+        help="number of independent minimizations, the one with the lowest entropy is kept",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="workers",
+        type=int,
+        default=None,
+        help="number of processes running the minimizations (default: number of cores)",
+    )
+    parser.add_argument(
+        "--seed",
+        metavar="seed",
+        type=int,
+        default=None,
+        help="seed of the first run, run i uses seed + i",
+    )
+    parser.add_argument(
+        "--refine-sweeps",
+        metavar="refine_sweeps",
+        type=int,
+        default=0,
+        help="total number of merge-split MCMC sweeps refining each minimized state",
+    )
+    parser.add_argument(
+        "--anneal",
+        action="store_true",
+        help="refine by simulated annealing instead of zero-temperature sweeps",
+    )
     parser.add_argument(
         "-o",
         "--output",
@@ -37,42 +210,27 @@ if __name__ == "__main__":
         required=True,
         help="output membership path",
     )
+    parser.add_argument(
+        "--graph-cache",
+        metavar="graph_cache",
+        type=str,
+        required=False,
+        default=None,
+        help="directory of the parsed graph cache shared across pipeline stages",
+    )
 
     args = parser.parse_args()
-    gt.openmp_set_num_threads(1)
-    sbm_graph = gt.Graph(directed=False)
-
-    def edge_list_iterable():
-        with open(args.edgelist, "r") as f:
-            for i, line in enumerate(f):
-                if i == 0:
-                    continue
-                u, v = line.strip().split(sep=",")
-                yield u, v
-
-    vpm_name = sbm_graph.add_edge_list(
-        edge_list_iterable(), hashed=True, hash_type="string"
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    run_sbm(
+        args.edgelist,
+        args.output,
+        args.b,
+        args.degree_corrected,
+        cache_dir=args.graph_cache,
+        threads=args.threads,
+        n_runs=args.n_runs,
+        workers=args.workers,
+        seed=args.seed,
+        refine_sweeps=args.refine_sweeps,
+        anneal=args.anneal,
     )
-    # vpm_name = sbm_graph.add_edge_list(edgelist_arr, hashed=True, hash_type="int")
-
-    sbm_clustering = None
-    if args.b == "non_nested_sbm":
-        if args.d:
-            sbm_clustering = gt.minimize_blockmodel_dl(
-                sbm_graph, state=gt.BlockState, state_args={"deg_corr": True}
-            )
-        else:
-            sbm_clustering = gt.minimize_blockmodel_dl(
-                sbm_graph, state=gt.BlockState, state_args={"deg_corr": False}
-            )
-    elif args.b == "planted_partition_model":
-        sbm_clustering = gt.minimize_blockmodel_dl(sbm_graph, state=gt.PPBlockState)
-
-    block_membership = sbm_clustering.get_blocks()
-
-    cluster_dict = {}
-    with open(args.output, "w") as f:
-        f.write(f"node_id,cluster_id\n")
-        for new_node_id in sbm_graph.vertices():
-            current_cluster_id = block_membership[new_node_id]
-            f.write(f"{vpm_name[new_node_id]},{current_cluster_id}\n")
@@ -1,44 +1,618 @@
 import os
-from toolkit import conversion_toolkit
+import sys
+import importlib
+from toolkit import conversion_toolkit, graph_cache
+from toolkit.profiling import StageProfile
 from toolkit.conversion_toolkit import FileType
 import time
+import glob
 import json
+import hashlib
 import argparse
+import logging
+import shutil
+import re
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 modules_location = os.path.abspath("./modules")
 external_modules_location = os.path.abspath("./downloaded_programs")
 toolkit_location = os.path.abspath("./toolkit")
 
+# Networks already parsed by in-process stages, keyed by path
+_loaded_networks = {}
+
+# Profile of the stage running in this process, see run_stage
+_current_profile = None
+
+# Methods that refine an input clustering, and so need an input stage
+clustering_methods = {"wcc", "cc", "aoc"}
+
+# Parameters every stage of a method must set
+required_params = {
+    "leiden-cpm": ["res"],
+    "sbm": ["block_state"],
+    "wcc": ["criterion"],
+    "cm": ["clusterer"],
+}
+
+# Program implementing each method, whose content is part of the stage cache key
+method_implementations = {
+    "leiden-mod": f"{modules_location}/run_leiden.py",
+    "leiden-cpm": f"{modules_location}/run_leiden.py",
+    "ikc": f"{modules_location}/run_ikc.py",
+    "infomap": f"{modules_location}/run_infomap.py",
+    "sbm": f"{modules_location}/run_sbm.py",
+    "wcc": f"{external_modules_location}/constrained_clustering",
+    "cc": f"{external_modules_location}/constrained_clustering",
+    "aoc": shutil.which("aocluster"),
+    "flow-iter": f"{external_modules_location}/flow-iter",
+    "flow": f"{external_modules_location}/flow",
+    "fista-int": f"{external_modules_location}/fista-int",
+    "fista-frac": f"{external_modules_location}/fista-frac",
+    "cm": f"{external_modules_location}/cm_pipeline/hm01/cm.py",
+}
+
 
 def _stage_output_path(
     working_dir,
     stage_number,
     method,
+    variant=None,
 ):
+    # method is the stage name, which may be user-given in a DAG pipeline
+    method = re.sub(r"[^A-Za-z0-9_.+=-]", "_", method)
+    if variant:
+        return f"{working_dir}/{stage_number}_{method}-{variant}"
     return f"{working_dir}/{stage_number}_{method}"
 
 
-def run_pipeline(input_network, working_dir, final_clustering, method_arr):
+def _import_module(name):
+    """Imports a module from the modules directory so it can be called in-process"""
+    if modules_location not in sys.path:
+        sys.path.insert(0, modules_location)
+    return importlib.import_module(name)
+
+
+def _run_command(command):
+    """Runs a stage's shell command, recording its resource usage in the current stage profile"""
+    if _current_profile is None:
+        return os.system(command)
+    return _current_profile.run(command)
+
+
+def _graph_cache_dir(working_dir):
+    return f"{working_dir}/graph_cache"
+
+
+def _load_network(network, working_dir):
+    """Loads a network from the graph cache once and keeps it for the following in-process stages"""
+    if network not in _loaded_networks:
+        _loaded_networks[network] = graph_cache.load_graph(
+            network, _graph_cache_dir(working_dir)
+        )
+    return _loaded_networks[network]
+
+
+def _stage_cache_dir(working_dir):
+    return f"{working_dir}/stage_cache"
+
+
+def _file_digest(path, working_dir):
+    if path is None:
+        return None
+    return graph_cache.file_digest(path, _graph_cache_dir(working_dir))
+
+
+def _stage_key(method, method_params, current_network, current_clustering, working_dir):
+    """Hash of everything that determines the output of a stage"""
+    implementation = method_implementations.get(method)
+    if implementation is not None and os.path.isfile(implementation):
+        version = _file_digest(implementation, working_dir)
+    else:
+        version = None
+
+    key = {
+        "network": _file_digest(current_network, working_dir),
+        "clustering": _file_digest(current_clustering, working_dir),
+        "method": method,
+        "method_params": method_params,
+        "version": version,
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _cached_stage(stage_key, working_dir):
+    """Returns the (network, clustering) recorded for stage_key if its outputs are still intact"""
+    record = f"{_stage_cache_dir(working_dir)}/{stage_key}.json"
+    if not os.path.exists(record):
+        return None
+    with open(record, "r") as f:
+        outputs = json.load(f)
+
+    for name in ["network", "clustering"]:
+        path = outputs[name]
+        if not os.path.exists(path):
+            return None
+        if _file_digest(path, working_dir) != outputs[f"{name}_digest"]:
+            return None
+    return outputs["network"], outputs["clustering"]
+
+
+def _wrote_clustering(clustering, started):
+    """Whether a stage started at `started` wrote its clustering (rather than failing and leaving
+    the output of an earlier run behind)"""
+    return (
+        clustering is not None
+        and os.path.exists(clustering)
+        and os.path.getmtime(clustering) >= started
+    )
+
+
+def _record_stage(stage_key, working_dir, network, clustering, started):
+    """Remembers the outputs of a stage that wrote its clustering after it started"""
+    if not _wrote_clustering(clustering, started):
+        return
+    os.makedirs(_stage_cache_dir(working_dir), exist_ok=True)
+    outputs = {
+        "network": network,
+        "clustering": clustering,
+        "network_digest": _file_digest(network, working_dir),
+        "clustering_digest": _file_digest(clustering, working_dir),
+    }
+    with open(f"{_stage_cache_dir(working_dir)}/{stage_key}.json", "w") as f:
+        json.dump(outputs, f, indent=4)
+
+
+def run_pipeline(
+    input_network, working_dir, final_clustering, method_arr, in_process=False
+):
     """This is a generic method that takes in an input network and runs all the methods in method_arr
     The output of the previous stage networks and clusterings get fed to the next stages input
+    If in_process is set, the python modules are called directly instead of in a new interpreter
+    Stages whose inputs, method, parameters and program are unchanged since a previous run in the
+    same working dir are skipped and their recorded outputs reused
+    """
+    stages = load_stages(method_arr)
+    check_dependencies(stages)
+    run_dag(
+        input_network,
+        working_dir,
+        final_clustering,
+        expand_stages(stages),
+        in_process=in_process,
+        max_workers=1,
+    )
+
+
+def run_stage(
+    method,
+    method_params,
+    current_network,
+    current_clustering,
+    working_dir,
+    stage_number,
+    in_process=False,
+    variant=None,
+    name=None,
+    siblings=None,
+):
+    """
+    Runs one stage through run_method, unless an identical stage already ran in working_dir
+    With siblings (see expand_stages), the outputs of the sibling stages are written by the same run
+    and recorded in the stage cache too, and the stage is skipped only if they are all cached
+    Returns the output network and clustering, and a report of the stage's resource usage
+    """
+    global _current_profile
+
+    report = {
+        "name": name or method,
+        "method": method,
+        "variant": variant,
+        "stage_number": stage_number,
+        "method_params": method_params,
+        "cached": False,
+    }
+
+    stage_key = _stage_key(
+        method, method_params, current_network, current_clustering, working_dir
+    )
+    sibling_keys = [
+        _stage_key(
+            method, sibling["params"], current_network, current_clustering, working_dir
+        )
+        for sibling in siblings or []
+    ]
+    cached = _cached_stage(stage_key, working_dir)
+    if cached is not None and all(
+        _cached_stage(key, working_dir) is not None for key in sibling_keys
+    ):
+        print(f"> Stage {stage_number} ({method}) is cached, skipping.\n")
+        report["cached"] = True
+        return cached[0], cached[1], report
+
+    print(f"> Stage {stage_number} started.")
+    started = time.time()
+
+    with StageProfile() as profile:
+        _current_profile = profile
+        try:
+            network, clustering = run_method(
+                method=method,
+                method_params=method_params,
+                current_network=current_network,
+                current_clustering=current_clustering,
+                working_dir=working_dir,
+                stage_number=stage_number,
+                in_process=in_process,
+                variant=variant,
+                name=name,
+                siblings=siblings,
+            )
+        finally:
+            _current_profile = None
+    report.update(profile.report)
+    if not _wrote_clustering(clustering, started):
+        raise RuntimeError(
+            f"pipeline stage {stage_number} ({name or method}): no clustering was written to {clustering}"
+        )
+    _record_stage(stage_key, working_dir, network, clustering, started)
+    for key, sibling in zip(sibling_keys, siblings or []):
+        sibling_output = _stage_output_path(
+            working_dir, stage_number, name or method, sibling["variant"]
+        )
+        _record_stage(key, working_dir, network, f"{sibling_output}.csv", started)
+
+    print(f"> Stage {stage_number} complete ({report['wall_time']:.2f}s).\n")
+    return network, clustering, report
+
+
+def load_stages(pipeline_spec):
+    """
+    Normalizes a pipeline spec into a list of stages {"name", "method", "params", "input"}
+    The spec is either a DAG, {"stages": [{"name": ..., "method": ..., "params": {...}, "input": ...}]},
+    where "input" names the stage whose network and clustering feed this one (none: the input network),
+    or the flat {method: params} dict, which is a chain in insertion order
+    """
+    if "stages" in pipeline_spec:
+        return [
+            {
+                "name": stage.get("name", stage["method"]),
+                "method": stage["method"],
+                "params": dict(stage.get("params", {})),
+                "input": stage.get("input"),
+            }
+            for stage in pipeline_spec["stages"]
+        ]
+
+    stages = []
+    previous_stage = None
+    for method, method_params in pipeline_spec.items():
+        stages.append(
+            {
+                "name": method,
+                "method": method,
+                "params": dict(method_params),
+                "input": previous_stage,
+            }
+        )
+        previous_stage = method
+    return stages
+
+
+def _topological_order(stages):
+    """Orders stages so that every stage comes after its input, raising on cycles"""
+    by_name = {stage["name"]: stage for stage in stages}
+    ordered = []
+    state = {}  # name -> "visiting" | "done"
+
+    def visit(stage):
+        if state.get(stage["name"]) == "done":
+            return
+        if state.get(stage["name"]) == "visiting":
+            raise ValueError(f"pipeline stage {stage['name']}: stages form a cycle")
+        state[stage["name"]] = "visiting"
+        if stage["input"] is not None:
+            visit(by_name[stage["input"]])
+        state[stage["name"]] = "done"
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def _param_grid(method_params):
+    """Yields every combination of the list-valued parameters, with the swept values of each"""
+    swept = [name for name, value in method_params.items() if isinstance(value, list)]
+    for values in itertools.product(*(method_params[name] for name in swept)):
+        params = dict(method_params)
+        params.update(zip(swept, values))
+        yield params, list(zip(swept, values))
+
+
+def _variant_name(swept):
+    """File-name friendly label of swept parameter values, e.g. res=0.1.k=10"""
+    return ".".join(
+        re.sub(r"[^A-Za-z0-9_.=-]", "_", f"{name}={value}") for name, value in swept
+    )
+
+
+def expand_stages(stages):
     """
-    previous_stage_network = input_network
-    previous_stage_clustering = None
-    for stage_number, method in enumerate(method_arr):
-        print(f"> Stage {stage_number + 1} started.")
-
-        previous_stage_network, previous_stage_clustering = run_method(
-            method=method,
-            method_params=method_arr[method],
-            current_network=previous_stage_network,
-            current_clustering=previous_stage_clustering,
+    Expands the stage DAG into stage jobs, in an order where every job comes after its upstream job
+    Parameters may be lists: every combination of a stage's list-valued parameters becomes one job per
+    upstream job, so a common prefix (e.g. ikc with k=10) is run once and feeds all the variants that
+    follow it
+    ikc jobs that only differ in their k are run together: the first one computes the clusterings of
+    all of them in one run ("siblings" lists the params and variant of the others), and the others run
+    after it (their "after" job), finding their outputs in the stage cache
+    """
+    jobs = []
+    stage_jobs = {}
+    stage_numbers = {}
+    for stage in _topological_order(stages):
+        if stage["input"] is None:
+            upstream_jobs = [None]
+            stage_numbers[stage["name"]] = 1
+        else:
+            upstream_jobs = stage_jobs[stage["input"]]
+            stage_numbers[stage["name"]] = stage_numbers[stage["input"]] + 1
+
+        stage_jobs[stage["name"]] = []
+        for upstream in upstream_jobs:
+            for params, swept in _param_grid(stage["params"]):
+                lineage_swept = (upstream["swept"] if upstream else []) + swept
+
+                # aoc defaults to the k of the ikc run feeding it
+                if stage["method"] == "aoc" and "m" not in params:
+                    ikc_job = _upstream_job(jobs, upstream, "ikc")
+                    params["m"] = f"k{ikc_job['params'].get('k', 0)}"
+
+                job = {
+                    "id": len(jobs),
+                    "name": stage["name"],
+                    "method": stage["method"],
+                    "params": params,
+                    "stage_number": stage_numbers[stage["name"]],
+                    "upstream": upstream["id"] if upstream else None,
+                    "swept": lineage_swept,
+                    "variant": _variant_name(lineage_swept),
+                    "after": None,
+                    "siblings": [],
+                }
+                jobs.append(job)
+                stage_jobs[stage["name"]].append(job)
+
+                if stage["method"] == "ikc" and "k" in dict(swept):
+                    _group_k(job, jobs[-2::-1], upstream)
+    return jobs
+
+
+def _group_k(job, earlier_jobs, upstream):
+    """Adds an ikc job to the group of an earlier job of its stage that only differs in k"""
+    other_params = {name: value for name, value in job["params"].items() if name != "k"}
+    for lead in earlier_jobs:
+        if lead["name"] != job["name"] or lead["upstream"] != job["upstream"]:
+            break
+        if lead["after"] is not None:
+            continue
+        lead_params = {name: value for name, value in lead["params"].items() if name != "k"}
+        if lead_params == other_params:
+            job["after"] = lead["id"]
+            lead["siblings"].append({"params": job["params"], "variant": job["variant"]})
+            return
+
+
+def _upstream_job(jobs, job, method):
+    """The closest job running method among job and its upstream jobs, if any"""
+    while job is not None and job["method"] != method:
+        job = jobs[job["upstream"]] if job["upstream"] is not None else None
+    return job
+
+
+def _final_output_path(final_clustering, job, multiple_final_stages):
+    """
+    Where the clustering of a final job goes: final_clustering itself when the pipeline has a single
+    final output, otherwise suffixed with the stage name (if there are several final stages) and variant
+    """
+    suffixes = []
+    if multiple_final_stages:
+        suffixes.append(job["name"])
+    if job["variant"]:
+        suffixes.append(job["variant"])
+    if len(suffixes) == 0:
+        return final_clustering
+    final_stem, final_extension = os.path.splitext(final_clustering)
+    return f"{final_stem}-{'-'.join(suffixes)}{final_extension}"
+
+
+def run_dag(
+    input_network,
+    working_dir,
+    final_clustering,
+    jobs,
+    in_process=False,
+    max_workers=None,
+):
+    """
+    Runs the stage jobs from expand_stages, each as soon as its upstream job is done
+    Independent jobs run concurrently on a pool of at most max_workers processes (defaults to the number
+    of cores). A plain chain, or max_workers=1, runs in this process, one stage after the other
+    The clustering of every final job is copied to final_clustering (see _final_output_path)
+    A report of every stage's resource usage is written to <working_dir>/run_report.json
+    """
+    downstream = {job["id"]: [] for job in jobs}
+    for job in jobs:
+        if job["upstream"] is not None:
+            downstream[job["upstream"]].append(job)
+    final_stages = {job["name"] for job in jobs if len(downstream[job["id"]]) == 0}
+    print(f"> Pipeline expanded into {len(jobs)} stage runs")
+    stage_reports = []
+    started = time.perf_counter()
+
+    def stage_arguments(job, network, clustering):
+        return dict(
+            siblings=job["siblings"],
+            method=job["method"],
+            method_params=job["params"],
+            current_network=network,
+            current_clustering=clustering,
             working_dir=working_dir,
-            stage_number=stage_number + 1,
+            stage_number=job["stage_number"],
+            in_process=in_process,
+            variant=job["variant"],
+            name=job["name"],
+        )
+
+    def finish(job, clustering):
+        if len(downstream[job["id"]]) > 0:
+            return
+        output = _final_output_path(final_clustering, job, len(final_stages) > 1)
+        label = " ".join(filter(None, [job["name"], job["variant"]]))
+        if clustering is not None and os.path.exists(clustering):
+            os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+            shutil.copyfile(clustering, output)
+            print(f"> Final clustering of {label} written to {output}")
+        else:
+            print(f"> {label} produced no clustering")
+
+    is_chain = all(len(following) <= 1 for following in downstream.values()) and (
+        sum(job["upstream"] is None for job in jobs) <= 1
+    )
+    try:
+        if max_workers == 1 or is_chain:
+            outputs = {}
+            for job in jobs:
+                network, clustering = (
+                    outputs[job["upstream"]]
+                    if job["upstream"] is not None
+                    else (input_network, None)
+                )
+                network, clustering, report = run_stage(
+                    **stage_arguments(job, network, clustering)
+                )
+                outputs[job["id"]] = (network, clustering)
+                stage_reports.append(report)
+                finish(job, clustering)
+            return
+
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            running = {}
+            inputs = {}
+
+            def submit(job, network, clustering):
+                inputs[job["id"]] = (network, clustering)
+                future = executor.submit(
+                    run_stage, **stage_arguments(job, network, clustering)
+                )
+                running[future] = job
+
+            for job in jobs:
+                if job["upstream"] is None and job["after"] is None:
+                    submit(job, input_network, None)
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    network, clustering, report = future.result()
+                    stage_reports.append(report)
+
+                    for downstream_job in downstream[job["id"]]:
+                        if downstream_job["after"] is None:
+                            submit(downstream_job, network, clustering)
+                    # the jobs whose outputs this job also wrote, on the same inputs
+                    for after_job in jobs:
+                        if after_job["after"] == job["id"]:
+                            submit(after_job, *inputs[job["id"]])
+                    finish(job, clustering)
+    finally:
+        # also reports the stages that completed before a failure
+        _write_run_report(
+            working_dir, input_network, stage_reports, time.perf_counter() - started
         )
 
-        print(f"> Stage {stage_number + 1} complete.\n")
 
-    os.system(f"cp {previous_stage_clustering} {final_clustering}")
+def _write_run_report(working_dir, input_network, stage_reports, wall_time):
+    report = {
+        "input_network": input_network,
+        "wall_time": wall_time,
+        "stages": stage_reports,
+    }
+    with open(f"{working_dir}/run_report.json", "w") as f:
+        json.dump(report, f, indent=4, default=str)
+    print(f"> Run report written to {working_dir}/run_report.json")
+
+
+def _leiden_options(method_params, current_clustering):
+    """
+    The optional parameters of a leiden stage, as run_leiden arguments and as command line flags
+    n_iters     : number of iterations, negative to iterate until convergence
+    warm_start  : start from the clustering of the input stage instead of singletons
+    time_budget : seconds after which no new iteration starts
+    """
+    options, flags = {}, ""
+    if "n_iters" in method_params:
+        options["n_iters"] = int(method_params["n_iters"])
+        flags += f" --n-iterations {options['n_iters']}"
+    if method_params.get("warm_start", False):
+        options["initial_membership"] = current_clustering
+        flags += f" --initial-membership {current_clustering}"
+    if "time_budget" in method_params:
+        options["time_budget"] = float(method_params["time_budget"])
+        flags += f" --time-budget {options['time_budget']}"
+    return options, flags
+
+
+def _infomap_options(method_params):
+    """
+    The optional parameters of an infomap stage, as run_infomap arguments and as command line flags
+    trials      : number of trials, run on separate processes, the lowest codelength is kept
+    seed        : seed of the first trial
+    two_level   : find a two-level partition instead of a module hierarchy
+    directed    : model the flow along the edges from source to target
+    time_limit  : seconds after which no new trial starts
+    workers     : number of processes running the trials
+    module_path : also write the path of every node's module in the hierarchy
+    """
+    options, flags = {}, ""
+    for name, convert in [("trials", int), ("seed", int), ("time_limit", float), ("workers", int)]:
+        if name in method_params:
+            options[name] = convert(method_params[name])
+            flags += f" --{name.replace('_', '-')} {options[name]}"
+    for name in ["two_level", "directed", "module_path"]:
+        if method_params.get(name, False):
+            options[name] = True
+            flags += f" --{name.replace('_', '-')}"
+    return options, flags
+
+
+def _sbm_options(method_params):
+    """
+    The optional parameters of an sbm stage, as run_sbm arguments and as command line flags
+    degree_corrected : run the degree-corrected model
+    threads          : number of OpenMP threads used by graph-tool
+    n_runs           : number of independent minimizations, the lowest entropy one is kept
+    workers          : number of processes running the minimizations
+    seed             : seed of the first run
+    refine_sweeps    : number of MCMC sweeps refining each minimized state
+    anneal           : refine by simulated annealing instead of zero-temperature sweeps
+    """
+    options, flags = {}, ""
+    if method_params.get("degree_corrected", False):
+        options["degree_corrected"] = True
+        flags += " -d"
+    for name in ["threads", "n_runs", "workers", "seed", "refine_sweeps"]:
+        if name in method_params:
+            options[name] = int(method_params[name])
+            flags += f" --{name.replace('_', '-')} {options[name]}"
+    if method_params.get("anneal", False):
+        options["anneal"] = True
+        flags += " --anneal"
+    return options, flags
 
 
 # TODO: move this to independent modules for maintenance
@@ -49,9 +623,20 @@ def run_method(
     current_clustering,
     working_dir,
     stage_number,
+    in_process=False,
+    variant=None,
+    name=None,
+    siblings=None,
 ):
-    """This method showcases different example commands for different programs."""
-    print(f">> Running {method} at stage {stage_number}")
+    """This method showcases different example commands for different programs.
+    With in_process, the python modules (leiden, ikc, infomap, sbm) are called directly
+    on the already loaded network. External binaries always run as subprocesses.
+    Outputs are named after the stage name (defaults to the method), and variant distinguishes the
+    outputs of the same stage run with different swept parameters.
+    siblings are the params and variants of ikc stages that only differ in k, whose clusterings are
+    written by the same run (see expand_stages).
+    """
+    print(f">> Running {method} ({name or method}) at stage {stage_number}")
     print(f">> Current network: {current_network}")
     print(f">> Current clustering: {current_clustering}")
     print(f">> Working directory: {working_dir}")
@@ -59,60 +644,106 @@ def run_method(
 
     if method == "leiden-mod":
         leiden_location = f"{modules_location}/run_leiden.py"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         leiden_output = f"{stage_output}.csv"
 
-        # TODO: n-iters
+        options, flags = _leiden_options(method_params, current_clustering)
 
-        os.system(
-            f"python {leiden_location} --edgelist {current_network} --output {leiden_output} --model mod"
-        )
+        if in_process:
+            _import_module("run_leiden").run_leiden(
+                current_network,
+                leiden_output,
+                model="mod",
+                graph=_load_network(current_network, working_dir),
+                **options,
+            )
+        else:
+            _run_command(
+                f"python {leiden_location} --edgelist {current_network} --output {leiden_output} --model mod --graph-cache {_graph_cache_dir(working_dir)}{flags}"
+            )
         return current_network, leiden_output
 
     elif method == "leiden-cpm":
         leiden_location = f"{modules_location}/run_leiden.py"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         leiden_output = f"{stage_output}.csv"
 
-        # TODO: n-iters
+        options, flags = _leiden_options(method_params, current_clustering)
 
-        os.system(
-            f"python {leiden_location} --edgelist {current_network} --output {leiden_output} --model cpm --resolution {method_params['res']}"
-        )
+        if in_process:
+            _import_module("run_leiden").run_leiden(
+                current_network,
+                leiden_output,
+                model="cpm",
+                resolution=float(method_params["res"]),
+                graph=_load_network(current_network, working_dir),
+                **options,
+            )
+        else:
+            _run_command(
+                f"python {leiden_location} --edgelist {current_network} --output {leiden_output} --model cpm --resolution {method_params['res']} --graph-cache {_graph_cache_dir(working_dir)}{flags}"
+            )
         return current_network, leiden_output
 
     elif method == "ikc":
         ikc_location = f"{modules_location}/run_ikc.py"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         ikc_output = f"{stage_output}.csv"
-        command = (
-            f"python {ikc_location} --edgelist {current_network} --output {ikc_output}"
-        )
+
+        # the clusterings of the sibling stages (other values of k) come out of the same run
+        ks = [int(method_params.get("k", 0))]
+        outputs = [ikc_output]
+        for sibling in siblings or []:
+            ks.append(int(sibling["params"]["k"]))
+            sibling_output = _stage_output_path(
+                working_dir, stage_number, name or method, sibling["variant"]
+            )
+            outputs.append(f"{sibling_output}.csv")
+        command = f"python {ikc_location} --edgelist {current_network} --output {' '.join(outputs)} --graph-cache {_graph_cache_dir(working_dir)}"
+
+        if in_process:
+            _import_module("run_ikc").run_ikc(
+                current_network,
+                outputs if siblings else ikc_output,
+                k=ks if siblings else ks[0],
+                graph=_load_network(current_network, working_dir),
+                modularity_check=bool(method_params.get("modularity_check", False)),
+            )
+            return current_network, ikc_output
 
         # Argument
         if "k" in method_params:
-            command = f"{command} -k {method_params['k']}"
-        os.system(command)
+            command = f"{command} -k {','.join(map(str, ks))}"
+        if method_params.get("modularity_check", False):
+            command = f"{command} --modularity-check"
+        _run_command(command)
         return current_network, ikc_output
 
     elif method == "infomap":
         infomap_location = f"{modules_location}/run_infomap.py"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         infomap_output = f"{stage_output}.csv"
-        os.system(
-            f"python {infomap_location} --edgelist {current_network} --output {infomap_output}"
-        )
+        options, flags = _infomap_options(method_params)
+        if in_process:
+            _import_module("run_infomap").run_infomap(
+                current_network,
+                infomap_output,
+                graph=_load_network(current_network, working_dir),
+                **options,
+            )
+        else:
+            _run_command(
+                f"python {infomap_location} --edgelist {current_network} --output {infomap_output} --graph-cache {_graph_cache_dir(working_dir)}{flags}"
+            )
         return current_network, infomap_output
 
     elif method == "sbm":
         sbm_location = f"{modules_location}/run_sbm.py"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         sbm_output = f"{stage_output}.csv"
 
         # Argument
-        command = (
-            f"python {sbm_location} --edgelist {current_network} --output {sbm_output}"
-        )
+        command = f"python {sbm_location} --edgelist {current_network} --output {sbm_output} --graph-cache {_graph_cache_dir(working_dir)}"
         if "block_state" in method_params:
             command = f"{command} -b {method_params['block_state']}"
         else:
@@ -120,18 +751,32 @@ def run_method(
                 f"pipeline stage {stage_number}: block_state is required for SBM"
             )
 
-        # TODO: degree-corrected
+        options, flags = _sbm_options(method_params)
+        command = f"{command}{flags}"
 
-        os.system(command)
+        if in_process:
+            _import_module("run_sbm").run_sbm(
+                current_network,
+                sbm_output,
+                method_params["block_state"],
+                graph=_load_network(current_network, working_dir),
+                **options,
+            )
+        else:
+            _run_command(command)
         return current_network, sbm_output
 
     elif method == "wcc":
         wcc_location = f"{external_modules_location}/constrained_clustering"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         wcc_output = f"{stage_output}.csv"
+        # constrained_clustering reads only character-delimited edgelists
+        text_network = conversion_toolkit.as_text(
+            current_network, _graph_cache_dir(working_dir)
+        )
 
         # Argument
-        command = f"{wcc_location} MincutOnly --edgelist {current_network} --existing-clustering {current_clustering} --output-file {wcc_output} --num-processors 1 --log-file {stage_output}.log --log-level 1"
+        command = f"{wcc_location} MincutOnly --edgelist {text_network} --existing-clustering {current_clustering} --output-file {wcc_output} --num-processors 1 --log-file {stage_output}.log --log-level 1"
 
         if "criterion" in method_params:
             command = (
@@ -142,29 +787,33 @@ def run_method(
                 f"pipeline stage {stage_number}: criterion is required for WCC"
             )
 
-        os.system(command)
+        _run_command(command)
         return current_network, wcc_output
 
     elif method == "cc":
         cc_location = f"{external_modules_location}/constrained_clustering"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         cc_output = f"{stage_output}.csv"
-        os.system(
-            f"{cc_location} MincutOnly --edgelist {current_network} --existing-clustering {current_clustering} --output-file {cc_output} --num-processors 1 --log-file {stage_output}.log --connectedness-criterion 0 --log-level 1"
+        # constrained_clustering reads only character-delimited edgelists
+        text_network = conversion_toolkit.as_text(
+            current_network, _graph_cache_dir(working_dir)
+        )
+        _run_command(
+            f"{cc_location} MincutOnly --edgelist {text_network} --existing-clustering {current_clustering} --output-file {cc_output} --num-processors 1 --log-file {stage_output}.log --connectedness-criterion 0 --log-level 1"
         )
         return current_network, cc_output
 
-    # TODO: AOC should only be called when there is IKC in the previous stage
     elif method == "aoc":
         # aoc_location = f"{external_modules_location}/aoc"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         aoc_output = f"{stage_output}.csv"
 
-        aoc_tmp_network = f"{stage_output}.tmp.edgelist"
         aoc_tmp_cluster = f"{stage_output}.tmp.clustering"
 
-        # Need to convert input files
-        conversion_toolkit.convert_to(current_network, aoc_tmp_network, " ", False)
+        # Need to convert input files (the network only once, it is shared by all stages)
+        aoc_tmp_network = conversion_toolkit.headerless(
+            current_network, " ", _graph_cache_dir(working_dir)
+        )
         conversion_toolkit.convert_to(current_clustering, aoc_tmp_cluster, " ", False)
 
         # Argument
@@ -174,7 +823,7 @@ def run_method(
         else:
             raise ValueError(f"pipeline stage {stage_number}: m is required for AOC")
 
-        os.system(
+        _run_command(
             # f"aocluster augment -g {aoc_tmp_network} -c {aoc_tmp_cluster} -m k{2} --candidates all --legacy-cid-nid-order --strategy legacy -o {aoc_output} -a 0"
             command
         )
@@ -184,7 +833,6 @@ def run_method(
         )
 
         # Remove temporary files
-        os.remove(aoc_tmp_network)
         os.remove(aoc_tmp_cluster)
 
         return current_network, aoc_output
@@ -192,18 +840,16 @@ def run_method(
     # DSC related
     elif method == "flow-iter" or method == "flow":
         flow_iter_location = f"{external_modules_location}/{method}"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         flow_iter_output_cluster = f"{stage_output}.csv"
         flow_iter_output_density = f"{stage_output}.density.csv"
 
-        flow_iter_tmp_network = f"{stage_output}.tmp.input.edgelist"
-
         # Remove header from input edgelist
-        conversion_toolkit.convert_to(
-            current_network, flow_iter_tmp_network, "\t", False
+        flow_iter_tmp_network = conversion_toolkit.headerless(
+            current_network, "\t", _graph_cache_dir(working_dir)
         )
 
-        os.system(
+        _run_command(
             f"{flow_iter_location} {flow_iter_tmp_network} {flow_iter_output_cluster} {flow_iter_output_density}"
         )
 
@@ -214,28 +860,25 @@ def run_method(
 
         # TODO: for now, leave density unchanged since it is not part of our standard specification
 
-        # Remove temporary files
-        os.remove(flow_iter_tmp_network)
-
         return current_network, flow_iter_output_cluster
 
     elif method == "fista-int" or method == "fista-frac":
         fista_location = f"{external_modules_location}/{method}"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         fista_output_cluster = f"{stage_output}.csv"
         fista_output_density = f"{stage_output}.density.csv"
 
-        fista_tmp_network = f"{stage_output}.tmp.input.edgelist"
-
         # Remove header from input edgelist
-        conversion_toolkit.convert_to(current_network, fista_tmp_network, "\t", False)
+        fista_tmp_network = conversion_toolkit.headerless(
+            current_network, "\t", _graph_cache_dir(working_dir)
+        )
 
         # Argument
         command = f"{fista_location} {fista_tmp_network} {fista_output_cluster} {fista_output_density}"
         if "niters" in method_params:
             command = f"{command} -niters {method_params['niters']}"
 
-        os.system(command)
+        _run_command(command)
 
         # Add header to the output cluster
         conversion_toolkit.convert_to_canonical(
@@ -244,23 +887,21 @@ def run_method(
 
         # TODO: for now, leave density unchanged since it is not part of our standard specification
 
-        # Remove temporary files
-        os.remove(fista_tmp_network)
-
         return current_network, fista_output_cluster
 
     # CM related
     elif method == "cm":
         cm_directory = f"{external_modules_location}/cm_pipeline/"
-        stage_output = _stage_output_path(working_dir, stage_number, method)
+        stage_output = _stage_output_path(working_dir, stage_number, name or method, variant)
         cm_output_cluster = os.path.abspath(f"{stage_output}.csv")
 
-        cm_tmp_network = os.path.abspath(f"{stage_output}.tmp.input.edgelist")
         if current_clustering is not None:
             cm_tmp_cluster = os.path.abspath(f"{stage_output}.tmp.input.cluster")
 
         # Remove header from input edgelist (& cluster if available)
-        conversion_toolkit.convert_to(current_network, cm_tmp_network, "\t", False)
+        cm_tmp_network = conversion_toolkit.headerless(
+            current_network, "\t", _graph_cache_dir(working_dir)
+        )
         if current_clustering is not None:
             conversion_toolkit.convert_to(
                 current_clustering, cm_tmp_cluster, "\t", False
@@ -312,7 +953,7 @@ def run_method(
             existing_clustering = method_params["existing-clustering"]
             command = f"{command} --existing-clustering {existing_clustering}"
 
-        os.system(command)
+        _run_command(command)
         print(command)
 
         os.chdir(current_directory)
@@ -323,7 +964,6 @@ def run_method(
         )
 
         # Remove temporary files
-        os.remove(cm_tmp_network)
         if current_clustering is not None:
             os.remove(cm_tmp_cluster)
 
@@ -334,19 +974,64 @@ def run_method(
     #     pass
 
 
-# TODO: this should be expanded to check for more dependencies
-def check_dependencies(stages: dict):
+def check_dependencies(stages: list):
+    """Validates the stage DAG from load_stages before any stage runs"""
+    names = [stage["name"] for stage in stages]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError(f"pipeline stage {name}: stage names must be unique")
+
+    by_name = {stage["name"]: stage for stage in stages}
+    for stage in stages:
+        name, method = stage["name"], stage["method"]
+        if method not in method_implementations:
+            raise ValueError(f"pipeline stage {name}: unknown method {method}")
+        if stage["input"] is not None and stage["input"] not in by_name:
+            raise ValueError(
+                f"pipeline stage {name}: input stage {stage['input']} does not exist"
+            )
+        if method in clustering_methods and stage["input"] is None:
+            raise ValueError(
+                f"pipeline stage {name}: {method} needs an input stage providing a clustering"
+            )
+        for param in required_params.get(method, []):
+            if param not in stage["params"]:
+                raise ValueError(
+                    f"pipeline stage {name}: {param} is required for {method}"
+                )
+        if stage["params"].get("warm_start", False) and stage["input"] is None:
+            raise ValueError(
+                f"pipeline stage {name}: warm_start needs an input stage providing a clustering"
+            )
+
+    # also raises on cycles
+    _topological_order(stages)
+
     # aoc should only work with ikc
-    if "aoc" in stages:
-        if "ikc" not in stages:
-            raise ValueError(f"AOC requires IKC in the previous stage")
-        else:
-            if "m" not in stages["aoc"]:
-                stages["aoc"]["m"] = f"k{stages['ikc']['k']}"
+    for stage in stages:
+        if stage["method"] != "aoc":
+            continue
+        upstream = stage
+        while upstream is not None and upstream["method"] != "ikc":
+            upstream = by_name[upstream["input"]] if upstream["input"] else None
+        if upstream is None:
+            raise ValueError(
+                f"pipeline stage {stage['name']}: AOC requires IKC in a previous stage"
+            )
 
 
 """ Step 1: specify input network, working directory, and final output clustering name"""
 """ Step 2: specify the methods, their parameters, and their order
+    Either as a flat {method: params} dict, run in order, or as a DAG of named stages where
+    each stage names its input stage, e.g.
+        {"stages": [
+            {"name": "leiden", "method": "leiden-cpm", "params": {"res": 0.01}},
+            {"name": "infomap", "method": "infomap"},
+            {"name": "leiden+cc", "method": "cc", "input": "leiden"},
+            {"name": "infomap+cc", "method": "cc", "input": "infomap"}
+        ]}
+    Stages that do not depend on each other run concurrently.
+
     List of possible method names for any stage that starts with an input network only:
         leiden-cpm (needs parameter called "res" for the resolution value)
         leiden-mod
@@ -403,19 +1088,50 @@ if __name__ == "__main__":
         default=None,
         help="Path to the final output clustering file",
     )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run the python modules inside this interpreter instead of one subprocess per stage",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        required=False,
+        default=None,
+        help="Maximum number of independent stages run in parallel (default: number of cores)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Reuse an existing working dir (the given one, or else the latest in ./outputs) and skip stages that are already done",
+    )
 
     args = parser.parse_args()
 
+    # Modules log their load/run/save times at INFO level
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # Argument processing
     input_pipeline = os.path.abspath(args.input_pipeline)
     input_network = os.path.abspath(args.input_network)
 
-    if args.working_dir is None:
-        working_dir = f"./outputs/working_dir-{time.time()}"
-    else:
+    if args.working_dir is not None:
         working_dir = args.working_dir
+    elif args.resume:
+        previous_working_dirs = glob.glob("./outputs/working_dir-*")
+        if len(previous_working_dirs) == 0:
+            parser.error("--resume: no previous working dir found in ./outputs")
+        working_dir = max(previous_working_dirs, key=os.path.getmtime)
+    else:
+        working_dir = f"./outputs/working_dir-{time.time()}"
     working_dir = os.path.abspath(working_dir)
 
+    if args.resume:
+        if not os.path.isdir(working_dir):
+            parser.error(f"--resume: working dir {working_dir} does not exist")
+        print(f"> Resuming in {working_dir}")
+
     if args.output_file is None:
         output_file = f"{working_dir}/final_clustering.csv"
     else:
@@ -427,10 +1143,17 @@ if __name__ == "__main__":
 
     # Read in pipeline
     with open(input_pipeline, "r") as pipeline:
-        method_arr = json.load(pipeline)
+        stages = load_stages(json.load(pipeline))
 
     # Check dependencies
-    check_dependencies(method_arr)
+    check_dependencies(stages)
 
     # Run pipeline
-    run_pipeline(input_network, working_dir, output_file, method_arr)
+    run_dag(
+        input_network,
+        working_dir,
+        output_file,
+        expand_stages(stages),
+        in_process=args.in_process,
+        max_workers=args.jobs,
+    )
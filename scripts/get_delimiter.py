@@ -1,13 +1,9 @@
-def get_delimiter(filepath: str) -> str:
-    with open(filepath, "r") as f:
-        for current_line in f:
-            if "," in current_line:
-                return ","
-            elif " " in current_line:
-                return " "
-            elif "\t" in current_line:
-                return "\t"
-            else:
-                raise ValueError(
-                    "Unsupported delimiter: delimiter must be either comma, tab, or whitespace."
-                )
+import sys
+from pathlib import Path
+
+# The detection itself is shared with the toolkit and the modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from toolkit.sniff import get_delimiter
+
+if __name__ == "__main__":
+    print(repr(get_delimiter(sys.argv[1])))
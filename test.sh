@@ -16,4 +16,20 @@ for test_input in "${test_inputs[@]}"; do
     done
 done
 
+# Converting a headerless file keeps every row exactly once
+printf '1 2\n3 4\n' > test-script-out/headerless.txt
+python toolkit/conversion_toolkit.py test-script-out/headerless.txt -d comma -o test-script-out/headerless.csv
+if [ "$(cat test-script-out/headerless.csv)" != "$(printf '1,2\n3,4')" ]; then
+    echo "Error: converting a headerless file did not keep its rows at test-script-out/headerless.csv"
+    exit 1
+fi
+
+# The deep format check reads every row of a valid edgelist
+for deep_options in "" "--directed"; do
+    if ! python toolkit/format_checker.py examples/edgelist.csv --format edgelist --deep $deep_options; then
+        echo "Error: the deep format check failed on examples/edgelist.csv $deep_options"
+        exit 1
+    fi
+done
+
 echo "All tests passed!"
\ No newline at end of file
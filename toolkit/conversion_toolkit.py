@@ -1,9 +1,24 @@
+import os
+import sys
+import stat
+import shutil
 import argparse
-import pandas as pd
+import tempfile
 from pathlib import Path
-import csv
 from enum import Enum
 
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from toolkit.sniff import get_delimiter, check_header
+
+# Block size used when streaming files through a conversion
+CHUNK_SIZE = 1 << 24
+
+# Rows written per block when converting a binary columnar file to text
+ROWS_PER_BLOCK = 1 << 20
+
 
 # Filetype defined in the spec
 class FileType(Enum):
@@ -12,44 +27,287 @@ class FileType(Enum):
     CLUSTER = 3
 
 
-def get_delimiter(filepath: str) -> str:
-    with open(filepath, "r") as f:
-        for current_line in f:
-            if "," in current_line:
-                return ","
-            elif " " in current_line:
-                return " "
-            elif "\t" in current_line:
-                return "\t"
-            else:
-                raise ValueError(
-                    "Unsupported delimiter: delimiter must be either comma, tab, or whitespace."
-                )
+# Required columns of each filetype, in spec order
+COLUMNS = {
+    FileType.NODELIST: ["node_id"],
+    FileType.EDGELIST: ["source", "target"],
+    FileType.CLUSTER: ["node_id", "cluster_id"],
+}
+
+# Columns holding node IDs, which the node-id dictionary of a binary columnar file applies to
+NODE_COLUMNS = ["node_id", "source", "target"]
+
+# Optional node-id dictionary of a binary columnar file
+NODE_DICTIONARY_FILE = "node_ids.npy"
 
 
 def convert(input, output, src_delimiter, tar_delimiter, tar_header):
+    """
+    Rewrites a character-delimited file with another delimiter and header, streaming it in
+    fixed-size blocks so memory use does not depend on the file size
+    tar_delimiter : target delimiter, None keeps src_delimiter
+    tar_header    : None/False drops the header, True keeps the input header, a list of names writes
+                    those names as the header
+    The input header (if any) is detected rather than assumed, so headerless inputs lose no rows
+    Input and output may be the same file
+    """
     print(
         f"Converting {input} to {output} with delimiter {tar_delimiter} and header {tar_header}"
     )
     Path(output).parent.mkdir(exist_ok=True, parents=True)
-    pd.read_csv(input, sep=src_delimiter).to_csv(
-        output, index=False, sep=tar_delimiter, header=tar_header
-    )
+    if tar_delimiter is None:
+        tar_delimiter = src_delimiter
+    has_header, _ = check_header(input, src_delimiter)
+
+    src_bytes = src_delimiter.encode()
+    tar_bytes = tar_delimiter.encode()
+
+    # write next to the output and move it in place at the end, which also allows input == output
+    fd, tmp_output = tempfile.mkstemp(dir=Path(output).parent, prefix=".tmp-")
+    try:
+        with open(input, "rb") as src, os.fdopen(fd, "wb") as tar:
+            input_header = src.readline() if has_header else None
+
+            if tar_header is True:
+                if input_header is not None:
+                    tar.write(input_header.replace(src_bytes, tar_bytes))
+            elif tar_header:
+                tar.write((tar_delimiter.join(tar_header) + "\n").encode())
+
+            if src_bytes == tar_bytes:
+                _copy_body(src, tar, src.tell())
+            else:
+                # delimiters are single bytes, so they never straddle two blocks
+                for block in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    tar.write(block.replace(src_bytes, tar_bytes))
+        _set_output_mode(tmp_output, output)
+        os.replace(tmp_output, output)
+    except BaseException:
+        os.remove(tmp_output)
+        raise
     print(f"Conversion completed")
 
 
+def _set_output_mode(tmp_path, output):
+    """
+    Gives a temporary output (created private by tempfile) the mode of the output it replaces, or
+    the mode a new file or directory gets under the current umask
+    """
+    if os.path.exists(output):
+        mode = stat.S_IMODE(os.stat(output).st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = (0o777 if os.path.isdir(tmp_path) else 0o666) & ~umask
+    os.chmod(tmp_path, mode)
+
+
+def _copy_body(src, tar, offset):
+    """
+    Copies src from byte offset to its end onto the current position of tar
+    The copy happens in the kernel (copy_file_range, a reflink on copy-on-write filesystems)
+    and falls back to a user-space copy where that is not supported
+    """
+    tar.flush()
+    size = os.fstat(src.fileno()).st_size
+    try:
+        while offset < size:
+            copied = os.copy_file_range(
+                src.fileno(), tar.fileno(), size - offset, offset_src=offset
+            )
+            if copied == 0:
+                break
+            offset += copied
+    except (AttributeError, OSError):
+        # no copy_file_range on this platform or across these filesystems
+        src.seek(offset)
+        shutil.copyfileobj(src, tar, CHUNK_SIZE)
+
+
 def convert_to(input, output, tar_delimiter, tar_header):
+    if is_columnar(input):
+        from_columnar(input, output, tar_delimiter, tar_header)
+        return
+    src_delimiter = get_delimiter(input)
+    convert(input, output, src_delimiter, tar_delimiter, tar_header)
+
+
+def is_columnar(path):
+    """Whether path is a file in the binary columnar format (a directory of .npy columns)"""
+    return os.path.isdir(path) and any(
+        name.endswith(".npy") for name in os.listdir(path)
+    )
+
+
+def read_columnar(path):
+    """
+    Memory-maps a binary columnar file
+    Returns its columns (name -> array, required columns first in spec order) and its node-id
+    dictionary, or None if node IDs are stored directly
+    """
+    names = [
+        name[: -len(".npy")]
+        for name in os.listdir(path)
+        if name.endswith(".npy") and name != NODE_DICTIONARY_FILE
+    ]
+    spec_order = ["source", "target", "node_id", "cluster_id"]
+    names.sort(key=lambda name: (spec_order + [name]).index(name))
+    columns = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in names
+    }
+
+    node_ids = None
+    if os.path.exists(os.path.join(path, NODE_DICTIONARY_FILE)):
+        node_ids = np.load(os.path.join(path, NODE_DICTIONARY_FILE), mmap_mode="r")
+    return columns, node_ids
+
+
+def _compact_int(values):
+    """Stores integer values as int32 when they fit"""
+    int32 = np.iinfo(np.int32)
+    if len(values) == 0 or (values.min() >= int32.min and values.max() <= int32.max):
+        return values.astype(np.int32)
+    return values.astype(np.int64)
+
+
+def to_columnar(input, output, filetype: FileType):
+    """
+    Converts a character-delimited file to the binary columnar format (see formats.md)
+    Integer node IDs are stored as they are; any other node IDs are replaced with indices into a
+    node-id dictionary
+    """
+    print(f"Converting {input} to binary columnar {output}")
+    names = COLUMNS[filetype]
+    delimiter = get_delimiter(input)
+    has_header, _ = check_header(input, delimiter)
+    df = pd.read_csv(
+        input,
+        sep=delimiter,
+        header=0 if has_header else None,
+        usecols=range(len(names)),
+    )
+    values = {name: df.iloc[:, i].to_numpy() for i, name in enumerate(names)}
+    del df
+
+    node_columns = [name for name in names if name in NODE_COLUMNS]
+    node_ids = None
+    if not all(np.issubdtype(values[name].dtype, np.integer) for name in node_columns):
+        codes, uniques = pd.factorize(
+            np.concatenate([values[name] for name in node_columns])
+        )
+        node_ids = np.asarray(uniques).astype(str)
+        for name, column_codes in zip(
+            node_columns, np.split(codes, len(node_columns))
+        ):
+            values[name] = column_codes
+
+    for name in names:
+        if not np.issubdtype(values[name].dtype, np.integer):
+            # e.g. string cluster IDs, which only need to be distinct
+            values[name] = pd.factorize(values[name])[0]
+        values[name] = _compact_int(values[name])
+
+    parent = os.path.dirname(os.path.abspath(output))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    for name in names:
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), values[name])
+    if node_ids is not None:
+        np.save(os.path.join(tmp_dir, NODE_DICTIONARY_FILE), node_ids)
+    _set_output_mode(tmp_dir, output)
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.rename(tmp_dir, output)
+    print(f"Conversion completed")
+
+
+def from_columnar(input, output, tar_delimiter=",", tar_header=True):
+    """
+    Converts a binary columnar file to a character-delimited file, block by block
+    tar_header : None/False writes no header, True writes the column names, a list of names writes
+                 those names
+    """
     print(
-        f"Converting {input} to {output} with delimiter {tar_delimiter} and header {tar_header}"
+        f"Converting binary columnar {input} to {output} with delimiter {tar_delimiter} and header {tar_header}"
     )
-    src_delimiter = get_delimiter(input)
+    columns, node_ids = read_columnar(input)
+    n_rows = len(next(iter(columns.values())))
+
     Path(output).parent.mkdir(exist_ok=True, parents=True)
-    pd.read_csv(input, sep=src_delimiter).to_csv(
-        output, index=False, sep=tar_delimiter, header=tar_header
-    )
+    fd, tmp_output = tempfile.mkstemp(dir=Path(output).parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", newline="") as tar:
+            if tar_header is True:
+                tar.write(tar_delimiter.join(columns) + "\n")
+            elif tar_header:
+                tar.write(tar_delimiter.join(tar_header) + "\n")
+
+            for start in range(0, n_rows, ROWS_PER_BLOCK):
+                block = {}
+                for name, column in columns.items():
+                    block[name] = np.asarray(column[start : start + ROWS_PER_BLOCK])
+                    if node_ids is not None and name in NODE_COLUMNS:
+                        block[name] = node_ids[block[name]]
+                pd.DataFrame(block).to_csv(
+                    tar, sep=tar_delimiter, header=False, index=False
+                )
+        _set_output_mode(tmp_output, output)
+        os.replace(tmp_output, output)
+    except BaseException:
+        os.remove(tmp_output)
+        raise
     print(f"Conversion completed")
 
 
+def as_text(input, cache_dir):
+    """
+    Returns the path of a character-delimited version of input, for programs that only read text
+    This is input itself unless it is binary columnar, in which case a canonical comma-delimited
+    version is written once to cache_dir, keyed by the content of input
+    """
+    if not is_columnar(input):
+        return input
+
+    # imported here since graph_cache itself depends on this module
+    from toolkit.graph_cache import file_digest
+
+    output = os.path.join(cache_dir, "text", f"{file_digest(input, cache_dir)}.csv")
+    if not os.path.exists(output):
+        from_columnar(input, output, ",", True)
+    return output
+
+
+def headerless(input, tar_delimiter, cache_dir):
+    """
+    Returns the path of a headerless version of input that uses tar_delimiter, for programs that do
+    not read headers
+    This is input itself when it already qualifies. Otherwise the version is written once to
+    cache_dir, keyed by the content of input, and reused by every later call (the header is dropped
+    with a kernel-side copy of the body when the delimiter already matches)
+    """
+    if is_columnar(input):
+        src_delimiter, has_header = None, True
+    else:
+        src_delimiter = get_delimiter(input)
+        has_header, _ = check_header(input, src_delimiter)
+        if src_delimiter == tar_delimiter and not has_header:
+            return input
+
+    # imported here since graph_cache itself depends on this module
+    from toolkit.graph_cache import file_digest
+
+    delimiter_name = {",": "comma", "\t": "tab", " ": "space"}[tar_delimiter]
+    output = os.path.join(
+        cache_dir, "headerless", f"{file_digest(input, cache_dir)}.{delimiter_name}"
+    )
+    if not os.path.exists(output):
+        if src_delimiter is None:
+            from_columnar(input, output, tar_delimiter, None)
+        else:
+            convert(input, output, src_delimiter, tar_delimiter, None)
+    return output
+
+
 # TODO: for now this assumes the file is "mostly correct."
 def convert_to_canonical(input, output, filetype: FileType):
     if filetype == FileType.NODELIST:
@@ -60,16 +318,6 @@ def convert_to_canonical(input, output, filetype: FileType):
         convert_to(input, output, ",", ["node_id", "cluster_id"])
 
 
-def check_header(filename, delimiter):
-    with open(filename, newline="") as f:
-        reader = csv.reader(f, delimiter=delimiter)
-        first_row = next(reader, [])
-
-        # detect header
-        has_header = any(not cell.isdigit() for cell in first_row)
-        return has_header, first_row
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Validate and process a character-delimited file, converting it to use a specified delimiter"
@@ -100,6 +348,12 @@ if __name__ == "__main__":
         action="store_true",
         help="Remove headers in the target file",
     )
+    parser.add_argument(
+        "--to-columnar",
+        default=None,
+        choices=["edgelist", "nodelist", "cluster"],
+        help="Convert the input, a file of the given format, to the binary columnar format at --output",
+    )
 
     args = parser.parse_args()
 
@@ -115,7 +369,6 @@ if __name__ == "__main__":
         args.output = args.input
 
     # Get delimiter
-    delimiter = get_delimiter(args.input)
     if args.delimiter == "\\t":
         args.delimiter = "\t"
     elif args.delimiter == "\\s":
@@ -123,6 +376,23 @@ if __name__ == "__main__":
     elif args.delimiter == "comma":
         args.delimiter = ","
 
+    # Binary columnar conversions
+    if args.to_columnar is not None or is_columnar(args.input):
+        if args.output is None or args.output == args.input:
+            parser.error("Binary columnar conversions need a separate --output")
+        if args.to_columnar is not None:
+            to_columnar(args.input, args.output, FileType[args.to_columnar.upper()])
+        else:
+            from_columnar(
+                args.input,
+                args.output,
+                args.delimiter or ",",
+                None if args.remove_header else args.header or True,
+            )
+        exit(0)
+
+    delimiter = get_delimiter(args.input)
+
     # Get header
     has_header, headers = check_header(args.input, delimiter)
 
@@ -144,6 +414,6 @@ if __name__ == "__main__":
                 (
                     None
                     if args.remove_header
-                    else headers if args.header is None else args.header
+                    else True if args.header is None else args.header
                 ),
             )
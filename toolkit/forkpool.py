@@ -0,0 +1,54 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# State of the running map_forked call, set before its processes are forked so that they share it
+# copy-on-write (e.g. a loaded graph) instead of receiving it pickled
+shared = {}
+
+
+def map_forked(fn, state, items, workers=None, time_limit=None):
+    """
+    Calls fn on every item and returns the results in the order of the items
+    fn runs in this process for a single worker, or else on a pool of up to workers processes forked
+    from this one (default: number of cores), and reads state from forkpool.shared
+    With a time_limit (seconds), no new call starts once it is spent (at least one always runs), and
+    only the results of the calls that ran are returned
+    """
+    start = time.perf_counter()
+    spent = lambda: time_limit is not None and time.perf_counter() - start >= time_limit
+
+    shared.update(state)
+    try:
+        workers = min(workers or os.cpu_count(), len(items))
+        if workers <= 1:
+            results = []
+            for item in items:
+                results.append(fn(item))
+                if spent():
+                    break
+            return results
+
+        results = {}
+        pending = list(reversed(range(len(items))))
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+
+            def submit():
+                index = pending.pop()
+                running[executor.submit(fn, items[index])] = index
+
+            running = {}
+            for _ in range(workers):
+                submit()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+                while pending and len(running) < workers and not spent():
+                    submit()
+        return [results[index] for index in sorted(results)]
+    finally:
+        shared.clear()
@@ -1,22 +1,28 @@
+import os
+import sys
+import mmap
 import argparse
+import numpy as np
 import pandas as pd
 from pathlib import Path
-import csv
-
-
-def get_delimiter(filepath: str) -> str:
-    with open(filepath, "r") as f:
-        for current_line in f:
-            if "," in current_line:
-                return ","
-            elif " " in current_line:
-                return " "
-            elif "\t" in current_line:
-                return "\t"
-            else:
-                raise ValueError(
-                    "Unsupported delimiter: delimiter must be either comma, tab, or whitespace."
-                )
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from toolkit.sniff import get_delimiter, check_header
+
+# Bytes of the file scanned by one worker at a time in a deep check, a worker's memory use being
+# a small multiple of it
+DEEP_CHUNK_SIZE = 1 << 23
+
+# Violations of each kind listed in a deep check report (all of them are counted)
+MAX_REPORTED = 20
+
+# Columns that must be unique together in every row of each format, and what they are called
+DEEP_KEYS = {
+    "edgelist": (["source", "target"], "edge"),
+    "nodelist": (["node_id"], "node_id"),
+    "cluster_list": (["node_id"], "node_id"),
+}
 
 
 def convert_delimiter(input, output, src_delimiter, tar_delimiter):
@@ -26,19 +32,209 @@ def convert_delimiter(input, output, src_delimiter, tar_delimiter):
 
 # TODO: enforce ordering
 def check_header_and_columns(filename, delimiter, required_cols):
-    with open(filename, newline="") as f:
-        reader = csv.reader(f, delimiter=delimiter)
-        first_row = next(reader, [])
+    has_header, first_row = check_header(filename, delimiter)
+
+    if has_header:
+        # first_row is the header
+        missing = [col for col in required_cols if col not in first_row]
+        return True, (len(missing) == 0), missing
+    else:
+        return False, (len(required_cols) == 0), required_cols
+
+
+def deep_check(filename, delimiter, key_columns, unordered=False, workers=None):
+    """
+    Checks every row of a character-delimited file with a header, in chunks of lines scanned in
+    parallel on up to workers processes (default: number of cores)
+    key_columns : indices of the columns that must be unique together in every row, e.g. source and
+                  target (with unordered, (a, b) and (b, a) are the same key, as in undirected graphs)
+    Rows are compared through 64-bit hashes of their key fields
+    Returns a report with the number of rows, the lines (1-based, the header is line 1) with the
+    wrong number of columns along with their number of columns, and the lines repeating the key of
+    an earlier line along with that line
+    """
+    if os.path.isdir(filename):
+        raise ValueError(f"{filename}: the deep check reads character-delimited files")
+    _, header = check_header(filename, delimiter)
+
+    # byte ranges of whole lines after the header
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        start = mm.find(b"\n") + 1 or size
+        bounds = [start]
+        while bounds[-1] < size:
+            end = mm.find(b"\n", min(bounds[-1] + DEEP_CHUNK_SIZE, size) - 1) + 1
+            bounds.append(end if end > 0 else size)
+    chunks = [
+        (filename, begin, end, delimiter, len(header), key_columns, unordered)
+        for begin, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+    workers = min(workers or os.cpu_count(), max(len(chunks), 1))
+    if workers == 1:
+        results = [_scan_chunk(*chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_scan_chunk, *zip(*chunks)))
+
+    # line number of the first line of every chunk
+    n_lines = np.array([result["n_lines"] for result in results], dtype=np.int64)
+    first_lines = 2 + np.cumsum(n_lines) - n_lines
+
+    bad_lines = np.concatenate(
+        [result["bad_lines"] + first for result, first in zip(results, first_lines)]
+        + [np.empty(0, dtype=np.int64)]
+    )
+    bad_columns = np.concatenate(
+        [result["bad_columns"] for result in results] + [np.empty(0, dtype=np.int64)]
+    )
+
+    # a sorted copy of the keys of all the rows finds the repeated keys, and only the rows holding
+    # one of those are then looked at, the first of each key being the original
+    keys = np.concatenate([result["keys"] for result in results] + [np.empty(0, np.uint64)])
+    sorted_keys = np.sort(keys)
+    repeated = np.unique(sorted_keys[1:][sorted_keys[1:] == sorted_keys[:-1]])
+    del sorted_keys
+    rows = np.empty(0, dtype=np.int64)
+    if len(repeated) > 0:
+        at = np.searchsorted(repeated, keys).clip(max=len(repeated) - 1)
+        rows = np.flatnonzero(repeated[at] == keys)
+    row_keys = keys[rows]
+    del keys
+    # grouped by key, in file order within each key
+    order = np.argsort(row_keys, kind="stable")
+    rows, row_keys = rows[order], row_keys[order]
+    first = np.ones(len(row_keys), dtype=bool)
+    first[1:] = row_keys[1:] != row_keys[:-1]
+    original_rows = rows[first][np.cumsum(first) - 1][~first]
+    duplicate_rows = rows[~first]
+    in_file_order = np.argsort(duplicate_rows, kind="stable")
+    duplicate_rows, original_rows = duplicate_rows[in_file_order], original_rows[in_file_order]
+
+    return {
+        "n_rows": int(n_lines.sum()),
+        "bad_lines": bad_lines,
+        "bad_columns": bad_columns,
+        "n_columns": len(header),
+        "duplicate_lines": _row_lines(duplicate_rows, bad_lines),
+        "duplicated_lines": _row_lines(original_rows, bad_lines),
+    }
+
+
+def _row_lines(rows, bad_lines):
+    """Line numbers of well-formed rows, which skip the header and the malformed lines"""
+    # the k-th malformed line is preceded by (line - 2 - k) well-formed rows
+    skipped = bad_lines - 2 - np.arange(len(bad_lines))
+    return rows + 2 + np.searchsorted(skipped, rows, side="right")
+
+
+def _scan_chunk(filename, begin, end, delimiter, n_columns, key_columns, unordered):
+    """
+    Scans the lines in bytes [begin, end) of a file
+    Returns the number of lines, the lines (0-based in the chunk) that do not have n_columns
+    columns with their number of columns, and the 64-bit keys of the other lines in order
+    """
+    # the mapping stays open as long as arrays read from it
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = np.frombuffer(mm, dtype=np.uint8, count=end - begin, offset=begin)
+
+    line_ends = np.flatnonzero(data == ord("\n"))
+    if len(data) > 0 and data[-1] != ord("\n"):
+        line_ends = np.r_[line_ends, len(data)]
+    line_starts = np.r_[0, line_ends[:-1] + 1]
+    # windows line endings
+    carriage = (line_ends > line_starts) & (data[np.maximum(line_ends - 1, 0)] == ord("\r"))
+    line_ends = line_ends - carriage
+
+    delimiters = np.flatnonzero(data == ord(delimiter))
+    delimiters = delimiters[_in_line(delimiters, line_starts, line_ends)]
+    counts = np.bincount(
+        np.searchsorted(line_ends, delimiters), minlength=len(line_ends)
+    )
+    good = counts == n_columns - 1
+    bad_lines = np.flatnonzero(~good)
+
+    # fields of the well-formed lines: field k ends at the k-th delimiter of its line
+    first_delimiter = (np.cumsum(counts) - counts)[good]
+    starts, ends = line_starts[good], line_ends[good]
+    hashes = []
+    for column in key_columns:
+        field_start = starts if column == 0 else delimiters[first_delimiter + column - 1] + 1
+        field_end = ends if column == n_columns - 1 else delimiters[first_delimiter + column]
+        hashes.append(_hash_fields(data, field_start, field_end))
+
+    if unordered and len(hashes) == 2:
+        hashes = [np.minimum(*hashes), np.maximum(*hashes)]
+    keys = np.zeros(len(starts), dtype=np.uint64)
+    for field_hash in hashes:
+        keys = _mix(keys * np.uint64(0x9E3779B97F4A7C15) + field_hash)
+
+    return {
+        "n_lines": len(line_ends),
+        "bad_lines": bad_lines,
+        "bad_columns": counts[bad_lines] + 1,
+        "keys": keys,
+    }
+
+
+def _in_line(positions, line_starts, line_ends):
+    """Whether each position falls before the end of its line (and not in a stripped \\r)"""
+    line = np.searchsorted(line_starts, positions, side="right") - 1
+    return positions < line_ends[line]
+
+
+def _hash_fields(data, starts, ends):
+    """
+    64-bit hash of the bytes of every field [start, end), as a polynomial in the bytes
+    The polynomials are built one byte position at a time over the fields at least that long, so
+    memory grows with the number of fields rather than their bytes
+    """
+    lengths = ends - starts
+    # longest fields first, so the fields still going at every position are a prefix
+    order = np.argsort(-lengths, kind="stable")
+    starts = starts[order]
+    longer = np.searchsorted(-lengths[order], -np.arange(lengths.max(initial=0)), side="left")
+    hashes = np.zeros(len(starts), dtype=np.uint64)
+    for position, n_fields in enumerate(longer.tolist()):
+        hashes[:n_fields] *= np.uint64(0x100000001B3)
+        hashes[:n_fields] += data[starts[:n_fields] + position]
+    result = np.empty_like(hashes)
+    result[order] = hashes
+    return _mix(result ^ lengths.astype(np.uint64))
+
+
+def _mix(x):
+    """splitmix64 finalizer, spreading every input bit over the 64 output bits"""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
 
-        # detect header
-        has_header = any(not cell.isdigit() for cell in first_row)
 
-        if has_header:
-            # first_row is the header
-            missing = [col for col in required_cols if col not in first_row]
-            return True, (len(missing) == 0), missing
-        else:
-            return False, (len(required_cols) == 0), required_cols
+def print_deep_report(report, duplicate_name):
+    """Prints the violations found by deep_check, returns whether there are none"""
+    print(f"Checked {report['n_rows']} rows")
+    n_bad = len(report["bad_lines"])
+    if n_bad > 0:
+        print(f"{n_bad} rows do not have {report['n_columns']} columns:")
+        for line, columns in zip(
+            report["bad_lines"][:MAX_REPORTED].tolist(),
+            report["bad_columns"][:MAX_REPORTED].tolist(),
+        ):
+            print(f"  line {line}: {columns} columns")
+    n_duplicates = len(report["duplicate_lines"])
+    if n_duplicates > 0:
+        print(f"{n_duplicates} rows repeat the {duplicate_name} of an earlier row:")
+        for line, first in zip(
+            report["duplicate_lines"][:MAX_REPORTED].tolist(),
+            report["duplicated_lines"][:MAX_REPORTED].tolist(),
+        ):
+            print(f"  line {line}: same {duplicate_name} as line {first}")
+    if n_bad > MAX_REPORTED or n_duplicates > MAX_REPORTED:
+        print(f"  (only the first {MAX_REPORTED} of each are listed)")
+    return n_bad == 0 and n_duplicates == 0
 
 
 if __name__ == "__main__":
@@ -60,6 +256,23 @@ if __name__ == "__main__":
         choices=["edgelist", "nodelist", "cluster_list"],
         help="Target format of the input. If specified, the script will check if it conforms to the specification",
     )
+    parser.add_argument(
+        "--deep",
+        action="store_true",
+        help="With --format, also check every row: its number of columns and that it is not a duplicate "
+        "(an edge, or a node_id in a nodelist or cluster list, seen on an earlier row)",
+    )
+    parser.add_argument(
+        "--directed",
+        action="store_true",
+        help="With --deep, an edge and its reverse are not duplicates of each other",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes scanning the file with --deep (default: number of cores)",
+    )
 
     args = parser.parse_args()
 
@@ -117,6 +330,19 @@ if __name__ == "__main__":
                     print(f"Missing columns: {missing}.")
                 exit(1)
 
+        if args.deep:
+            key_names, duplicate_name = DEEP_KEYS[args.format]
+            _, header = check_header(args.input, delimiter)
+            report = deep_check(
+                args.input,
+                delimiter,
+                [header.index(name) for name in key_names],
+                unordered=args.format == "edgelist" and not args.directed,
+                workers=args.workers,
+            )
+            if not print_deep_report(report, duplicate_name):
+                exit(1)
+
     # Convert delimiter
     if args.delimiter is not None:
         if args.delimiter == delimiter:
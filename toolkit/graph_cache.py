@@ -0,0 +1,181 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from toolkit.conversion_toolkit import is_columnar, read_columnar
+from toolkit.sniff import get_delimiter, check_header
+
+
+# Files making up one cached graph
+OFFSETS_FILE = "offsets.npy"
+TARGETS_FILE = "targets.npy"
+NODE_IDS_FILE = "node_ids.npy"
+
+
+class CachedGraph:
+    """
+    A parsed edgelist in compressed sparse row form
+    offsets  : int64 array of length n + 1, the edges of node i are targets[offsets[i]:offsets[i + 1]]
+    targets  : int32/int64 array of length m with the compact target ID of every edge
+    node_ids : array of length n mapping compact node IDs back to the original node IDs
+    Nodes are numbered in order of first appearance in the edgelist
+    """
+
+    def __init__(self, offsets, targets, node_ids):
+        self.offsets = offsets
+        self.targets = targets
+        self.node_ids = node_ids
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.targets)
+
+    def sources(self):
+        """Compact source ID of every edge, aligned with targets"""
+        return np.repeat(
+            np.arange(self.n_nodes, dtype=self.targets.dtype), np.diff(self.offsets)
+        )
+
+    def edge_array(self):
+        """(m, 2) array of compact (source, target) pairs"""
+        return np.column_stack((self.sources(), self.targets))
+
+
+def file_digest(filepath, cache_dir=None):
+    """
+    Returns the sha256 of the file content
+    When cache_dir is given, the digest is remembered there for the file's path, size and mtime
+    so that unchanged files are not hashed again
+    A binary columnar file (a directory) hashes to the digest of its column files
+    """
+    filepath = os.path.abspath(filepath)
+    if os.path.isdir(filepath):
+        sha = hashlib.sha256()
+        for name in sorted(os.listdir(filepath)):
+            if name.endswith(".npy"):
+                column_digest = file_digest(os.path.join(filepath, name), cache_dir)
+                sha.update(f"{name}:{column_digest}".encode())
+        return sha.hexdigest()
+
+    stat = os.stat(filepath)
+    key = {"path": filepath, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    record = None
+    if cache_dir is not None:
+        path_hash = hashlib.sha1(filepath.encode()).hexdigest()
+        record = os.path.join(cache_dir, "digests", f"{path_hash}.json")
+        if os.path.exists(record):
+            with open(record, "r") as f:
+                saved = json.load(f)
+            if all(saved.get(name) == value for name, value in key.items()):
+                return saved["digest"]
+
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if record is not None:
+        os.makedirs(os.path.dirname(record), exist_ok=True)
+        _atomic_json_dump({**key, "digest": digest}, record)
+    return digest
+
+
+def parse_edgelist(edgelist):
+    """Parses a character-delimited or binary columnar edgelist into a CachedGraph held in memory"""
+    if is_columnar(edgelist):
+        columns, node_ids = read_columnar(edgelist)
+        return _to_csr(columns["source"], columns["target"], node_ids)
+
+    delimiter = get_delimiter(edgelist)
+    has_header, _ = check_header(edgelist, delimiter)
+    df = pd.read_csv(
+        edgelist,
+        sep=delimiter,
+        header=0 if has_header else None,
+        usecols=[0, 1],
+    )
+    return _to_csr(df.iloc[:, 0].to_numpy(), df.iloc[:, 1].to_numpy())
+
+
+def _to_csr(sources, targets, dictionary=None):
+    """
+    Builds a CachedGraph from the source and target node ID of every edge
+    With a dictionary, the IDs are indices into it and the node-id table maps back to its entries
+    """
+    # interleave the columns so that nodes are numbered in order of first appearance
+    endpoints = np.column_stack((np.asarray(sources), np.asarray(targets)))
+    codes, uniques = pd.factorize(endpoints.ravel(), sort=False)
+    n = len(uniques)
+    codes = codes.astype(np.int32 if n < np.iinfo(np.int32).max else np.int64)
+    sources, targets = codes[0::2], codes[1::2]
+
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=offsets[1:])
+
+    node_ids = np.asarray(uniques)
+    if dictionary is not None:
+        node_ids = np.asarray(dictionary)[node_ids]
+    if node_ids.dtype == object:
+        node_ids = node_ids.astype(str)
+    return CachedGraph(offsets, targets[order], node_ids)
+
+
+def load_graph(edgelist, cache_dir=None):
+    """
+    Loads an edgelist as a CachedGraph
+    With a cache_dir, the edgelist is parsed only once: the CSR arrays are stored under the hash
+    of its content and memory-mapped on every later load
+    The modules take both a graph and a cache_dir: the graph is a CachedGraph the pipeline already
+    loaded when it runs stages in-process, and without one the module calls load_graph with its
+    cache_dir (None parses the edgelist directly)
+    """
+    if cache_dir is None:
+        return parse_edgelist(edgelist)
+
+    graph_dir = os.path.join(cache_dir, file_digest(edgelist, cache_dir))
+    if not os.path.isdir(graph_dir):
+        save_graph(parse_edgelist(edgelist), graph_dir)
+    return read_graph(graph_dir)
+
+
+def save_graph(graph, graph_dir):
+    """Writes a CachedGraph to graph_dir, atomically so concurrent stages never see partial files"""
+    parent = os.path.dirname(os.path.abspath(graph_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    np.save(os.path.join(tmp_dir, OFFSETS_FILE), graph.offsets)
+    np.save(os.path.join(tmp_dir, TARGETS_FILE), graph.targets)
+    np.save(os.path.join(tmp_dir, NODE_IDS_FILE), graph.node_ids)
+    try:
+        os.rename(tmp_dir, graph_dir)
+    except OSError:
+        # another process cached the same graph first
+        shutil.rmtree(tmp_dir)
+
+
+def read_graph(graph_dir):
+    """Memory-maps a CachedGraph written by save_graph"""
+    return CachedGraph(
+        np.load(os.path.join(graph_dir, OFFSETS_FILE), mmap_mode="r"),
+        np.load(os.path.join(graph_dir, TARGETS_FILE), mmap_mode="r"),
+        np.load(os.path.join(graph_dir, NODE_IDS_FILE), mmap_mode="r"),
+    )
+
+
+def _atomic_json_dump(obj, path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+import time
+import logging
+import resource
+import subprocess
+
+import psutil
+
+# Matches the "[TIME] <step>: <seconds>" lines the modules log
+TIME_PATTERN = re.compile(r"\[TIME\] (.+): ([0-9.eE+-]+)")
+
+
+class _TimeLogHandler(logging.Handler):
+    """Collects [TIME] records logged by modules running in this process"""
+
+    def __init__(self, module_times):
+        super().__init__(level=logging.INFO)
+        self.module_times = module_times
+
+    def emit(self, record):
+        match = TIME_PATTERN.search(record.getMessage())
+        if match:
+            _add_time(self.module_times, match.group(1), float(match.group(2)))
+
+
+def _add_time(module_times, step, seconds):
+    module_times[step] = module_times.get(step, 0) + seconds
+
+
+class StageProfile:
+    """
+    Measures the resources used by one pipeline stage, both in this process (in-process modules,
+    file conversions) and in the commands it runs through run()
+    wall_time      : elapsed seconds
+    cpu_time       : user + system seconds of this process and of the processes it reaped during the
+                     stage (the commands, and the workers forked by in-process modules)
+    peak_rss_bytes : peak resident set size of the largest of those processes, or of this process
+                     during the stage (its peak since it started where the peak cannot be reset)
+    read_bytes     : bytes read through read() and similar calls, whether from disk or the page cache
+    written_bytes  : bytes written through write() and similar calls
+    module_times   : the load/run/save breakdown the modules log as [TIME] lines
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.module_times = {}
+        self.report = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # the counters of this process also take in the commands it reaped
+        self._io = psutil.Process().io_counters()
+        _reset_peak_rss()
+
+        self._handler = _TimeLogHandler(self.module_times)
+        root = logging.getLogger()
+        self._root_level = root.level
+        root.addHandler(self._handler)
+        root.setLevel(min(root.level, logging.INFO))
+        return self
+
+    def __exit__(self, *exc_info):
+        root = logging.getLogger()
+        root.removeHandler(self._handler)
+        root.setLevel(self._root_level)
+
+        # the children's usage covers the commands and the processes forked by in-process modules
+        # (e.g. through forkpool) once they are reaped
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time = _cpu_time(usage) - _cpu_time(self._usage)
+        cpu_time += _cpu_time(children_usage) - _cpu_time(self._children_usage)
+        io = psutil.Process().io_counters()
+        peak_rss = _peak_rss()
+
+        # the children's peak is the largest of any child so far, so it only tells about this stage
+        # once it grew
+        if children_usage.ru_maxrss > self._children_usage.ru_maxrss:
+            peak_rss = max(peak_rss, children_usage.ru_maxrss * 1024)
+        for command in self.commands:
+            peak_rss = max(peak_rss, command["peak_rss_bytes"])
+
+        self.report = {
+            "wall_time": time.perf_counter() - self._start,
+            "cpu_time": cpu_time,
+            "peak_rss_bytes": peak_rss,
+            "read_bytes": io.read_chars - self._io.read_chars,
+            "written_bytes": io.write_chars - self._io.write_chars,
+            "module_times": self.module_times,
+            "commands": self.commands,
+        }
+        return False
+
+    def run(self, command):
+        """
+        Runs a shell command like os.system and records its resource usage
+        The command's stderr is passed through, picking up the [TIME] lines it logs
+        Returns the exit status of the command
+        """
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command, shell=True, stderr=subprocess.PIPE, text=True, errors="replace"
+        )
+        for line in process.stderr:
+            sys.stderr.write(line)
+            match = TIME_PATTERN.search(line)
+            if match:
+                _add_time(self.module_times, match.group(1), float(match.group(2)))
+        process.stderr.close()
+
+        # wait4 gives the usage of this command (and the processes it waited for) alone, and reaping
+        # it adds its I/O to the counters of this process
+        io = psutil.Process().io_counters()
+        _, status, usage = os.wait4(process.pid, 0)
+        reaped_io = psutil.Process().io_counters()
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        self.commands.append(
+            {
+                "command": command,
+                "returncode": process.returncode,
+                "wall_time": time.perf_counter() - start,
+                "cpu_time": _cpu_time(usage),
+                "peak_rss_bytes": usage.ru_maxrss * 1024,
+                "read_bytes": reaped_io.read_chars - io.read_chars,
+                "written_bytes": reaped_io.write_chars - io.write_chars,
+            }
+        )
+        return process.returncode
+
+
+def _cpu_time(usage):
+    """User + system seconds of a getrusage/wait4 result"""
+    return usage.ru_utime + usage.ru_stime
+
+
+def _reset_peak_rss():
+    """Resets the peak resident set size of this process to its current size, where linux allows it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes, since the last _reset_peak_rss"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on linux
@@ -0,0 +1,158 @@
+import os
+import csv
+import json
+import tempfile
+
+# Bytes read from the start of a file to sniff its layout
+SAMPLE_SIZE = 1 << 14
+
+# Delimiters in order of precedence, as in scripts/get_delimiter.cpp
+DELIMITERS = [",", "\t", " "]
+
+# Results sniffed in this process, by (path, size, mtime)
+_sniffed = {}
+
+
+def sniff(filepath: str) -> dict:
+    """
+    Determines the layout of a character-delimited file from a sample of its first lines
+    delimiter   : the delimiter used by every sampled line (comma, then tab, then space)
+    has_header  : whether the first row is a header, i.e. has a cell that is not a number
+    first_row   : cells of the first row
+    n_columns   : number of columns of the first row
+    integer_ids : whether the first column (the node IDs) holds integers in every sampled row
+    The result is remembered in a sidecar file next to the input, keyed on its size and mtime, so
+    the file is sampled only once across the stages of a pipeline
+    A binary columnar file (see formats.md) is reported as a comma-delimited file with a header,
+    the form it is converted to
+    """
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    key = (filepath, stat.st_size, stat.st_mtime_ns)
+    if key in _sniffed:
+        return _sniffed[key]
+
+    if os.path.isdir(filepath):
+        result = _sniff_columnar(filepath)
+        _sniffed[key] = result
+        return result
+
+    sidecar = _sidecar_path(filepath)
+    result = _read_sidecar(sidecar, stat)
+    if result is None:
+        result = _sniff_sample(filepath)
+        _write_sidecar(sidecar, stat, result)
+    _sniffed[key] = result
+    return result
+
+
+def get_delimiter(filepath: str) -> str:
+    return sniff(filepath)["delimiter"]
+
+
+def check_header(filename, delimiter=None):
+    """Returns whether the file has a header, and the cells of its first row"""
+    result = sniff(filename)
+    if delimiter is None or delimiter == result["delimiter"]:
+        return result["has_header"], result["first_row"]
+
+    # split with a delimiter other than the detected one
+    with open(filename, newline="") as f:
+        first_row = next(csv.reader(f, delimiter=delimiter), [])
+    return _is_header(first_row), first_row
+
+
+def _sniff_sample(filepath):
+    with open(filepath, "r", newline="") as f:
+        sample = f.read(SAMPLE_SIZE)
+        at_end = f.read(1) == ""
+
+    lines = sample.splitlines()
+    if not at_end and len(lines) > 1:
+        # the last line may be cut off
+        lines = lines[:-1]
+    lines = [line for line in lines if line]
+    if len(lines) == 0:
+        raise ValueError(f"Could not detect the delimiter of empty file {filepath}")
+
+    delimiter = _pick_delimiter(lines)
+    rows = list(csv.reader(lines, delimiter=delimiter))
+    first_row = rows[0]
+    has_header = _is_header(first_row)
+    data_rows = rows[1:] if has_header else rows
+    return {
+        "delimiter": delimiter,
+        "has_header": has_header,
+        "first_row": first_row,
+        "n_columns": len(first_row),
+        "integer_ids": all(_is_integer(row[0]) for row in data_rows if row),
+    }
+
+
+def _pick_delimiter(lines):
+    """The first delimiter (in order of precedence) that appears in every line, else in any line"""
+    for delimiter in DELIMITERS:
+        if all(delimiter in line for line in lines):
+            return delimiter
+    for delimiter in DELIMITERS:
+        if any(delimiter in line for line in lines):
+            return delimiter
+    raise ValueError(
+        "Unsupported delimiter: delimiter must be either comma, tab, or whitespace."
+    )
+
+
+def _is_header(row):
+    return any(not cell.isdigit() for cell in row)
+
+
+def _is_integer(cell):
+    return cell.lstrip("-").isdigit()
+
+
+def _sniff_columnar(path):
+    import numpy as np
+
+    names = [name[: -len(".npy")] for name in os.listdir(path) if name.endswith(".npy")]
+    integer_ids = True
+    if "node_ids" in names:
+        names.remove("node_ids")
+        node_ids = np.load(os.path.join(path, "node_ids.npy"), mmap_mode="r")
+        integer_ids = bool(np.issubdtype(node_ids.dtype, np.integer))
+    spec_order = ["source", "target", "node_id", "cluster_id"]
+    names.sort(key=lambda name: (spec_order + [name]).index(name))
+    return {
+        "delimiter": ",",
+        "has_header": True,
+        "first_row": names,
+        "n_columns": len(names),
+        "integer_ids": integer_ids,
+    }
+
+
+def _sidecar_path(filepath):
+    directory, name = os.path.split(filepath)
+    return os.path.join(directory, f".{name}.sniff.json")
+
+
+def _read_sidecar(sidecar, stat):
+    try:
+        with open(sidecar, "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if saved.get("size") != stat.st_size or saved.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+    return saved.get("result")
+
+
+def _write_sidecar(sidecar, stat, result):
+    record = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "result": result}
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(sidecar), prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, sidecar)
+    except OSError:
+        # e.g. a read-only input directory, the file is then sampled again next time
+        pass